@@ -1,24 +1,48 @@
 # -*- coding: utf-8 -*-`
 """This API allows access to game logic for an implementation of Hangman"""
 
+from datetime import date
+
 import endpoints
 from protorpc import remote, messages
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 from models import (User,
                     Game,
-                    Score)
+                    Score,
+                    Leaderboard,
+                    LEADERBOARD_SIZE,
+                    ACTIVE_GAMES_COUNTER,
+                    ACTIVE_TRIES_COUNTER)
 from models import (StringMessage,
                     NewGameForm,
+                    NewGamesForm,
                     GameForm,
                     MakeMoveForm,
+                    MakeMovesForm,
+                    MoveResult,
+                    MoveResults,
                     ScoreForms,
                     UserGames,
                     UserRankings,
-                    GameHistory)
-from utils import get_by_urlsafe
-from gamefunc import rand_english_word
+                    GameHistory,
+                    HintForm)
+import candidates
+import counters
+import gamecache
+import metrics
+import queries
+from utils import (fetch_page_async,
+                   get_user_key,
+                   get_user_key_async,
+                   get_user_name,
+                   get_user_names,
+                   get_user_names_async,
+                   forget_user_name,
+                   schedule_debounced)
+from gamefunc import rand_english_word, select_word
+from gamestate import MISS, WIN
 
 ################################################################################
     ### GAE Resource Containers: ###
@@ -28,20 +52,40 @@ GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
 DEL_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GET_GAMES_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_keys=messages.StringField(1, repeated=True),)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
+GET_HINT_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),)
 GET_GAME_HISTORY = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 USER_GAMES = endpoints.ResourceContainer(UserGames)
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        page_size=messages.IntegerField(2),
+        cursor=messages.StringField(3))
+PAGE_REQUEST = endpoints.ResourceContainer(
+        page_size=messages.IntegerField(1),
+        cursor=messages.StringField(2))
 LEADERBOARD = endpoints.ResourceContainer(
-                                     number_of_results=messages.IntegerField(1))
+                                     number_of_results=messages.IntegerField(1),
+                                     window=messages.StringField(2))
 MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+AVERAGE_ATTEMPTS_INTERVAL = 60
+MAX_BULK_GAMES = 500
+MAX_LETTERS = 26
 
 
 @endpoints.api(name='paulshangman', version='v1')
+@metrics.instrument
 class PaulsHangmanApi(remote.Service):
     """Game API"""
 
@@ -57,32 +101,44 @@ class PaulsHangmanApi(remote.Service):
                       http_method='POST')
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException(
+                    'No user name supplied.')
+        if get_user_key(request.user_name):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
         if not request.email:
             raise endpoints.BadRequestException(
                     'No email address supplied.')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        # The name is claimed transactionally, a concurrent create loses here.
+        if not User.create(request.user_name, request.email):
+            raise endpoints.ConflictException(
+                    'A User with that name already exists!')
+        forget_user_name(request.user_name)
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=UserGames,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @ndb.synctasklet
     def get_user_games(self, request):
-        """Returns all of an individual User's games"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns an individual User's active games, one page at a time"""
+        user_key = yield get_user_key_async(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key).filter(
-                                                        Game.game_over == False,
-                                                     Game.game_deleted == False)
-        return UserGames(items=[game.to_form('Active Game.') for game in games])
+        games, next_cursor = yield fetch_page_async(queries.user_games(user_key),
+                                                    request.page_size,
+                                                    request.cursor)
+        # Games in play may have newer moves in the session cache.
+        games = yield gamecache.overlay_async(games)
+        raise ndb.Return(UserGames(
+                items=[game.to_form('Active Game.', request.user_name)
+                       for game in games],
+                next_cursor=next_cursor))
 
 ################################################################################
     ### Game Management Methods ###
@@ -94,53 +150,149 @@ class PaulsHangmanApi(remote.Service):
                       http_method='POST')
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = get_user_key(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        try:
-            game_word = rand_english_word(request.word_size)
-        except ValueError:
-            raise endpoints.BadRequestException('No target words of requested '
-                                                'length available!')
+        game_word = self._pick_word(request)
 
         # Input has been validated, generating game object.
-        game = Game.new_game(user.key, game_word, request.attempts)
+        game = Game.new_game(user_key, game_word, request.attempts)
 
         # Use a task queue to update the average attempts remaining.
         # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        return game.to_form('Good luck playing Pauls Hangman!')
+        # so it is performed out of sequence, and at most once per interval.
+        schedule_debounced('/tasks/cache_average_attempts',
+                           'cache-average-attempts',
+                           AVERAGE_ATTEMPTS_INTERVAL)
+        return game.to_form('Good luck playing Pauls Hangman!',
+                            request.user_name)
+
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=UserGames,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    def new_games(self, request):
+        """Creates games_per_user new games for each user, written in one
+        batch"""
+        if not request.user_names:
+            raise endpoints.BadRequestException('No user names supplied.')
+        count = len(request.user_names) * request.games_per_user
+        if request.games_per_user < 1 or count > MAX_BULK_GAMES:
+            raise endpoints.BadRequestException(
+                    'Between 1 and {} games can be created at once.'.format(
+                                                                MAX_BULK_GAMES))
+        players = []
+        for user_name in request.user_names:
+            user_key = get_user_key(user_name)
+            if not user_key:
+                raise endpoints.NotFoundException(
+                        'A User with the name {} does not exist!'.format(
+                                                                    user_name))
+            players.extend((user_key, self._pick_word(request))
+                           for i in range(request.games_per_user))
+
+        games = Game.new_games(players, request.attempts)
+        schedule_debounced('/tasks/cache_average_attempts',
+                           'cache-average-attempts',
+                           AVERAGE_ATTEMPTS_INTERVAL)
+        names = get_user_names(game.user for game in games)
+        return UserGames(items=[
+                game.to_form('Good luck playing Pauls Hangman!',
+                             names.get(game.user)) for game in games])
+
+    @staticmethod
+    def _pick_word(request):
+        """Returns a target word for a NewGameForm or NewGamesForm"""
+        try:
+            if request.difficulty or request.max_rank:
+                return select_word(request.word_size,
+                                   request.difficulty,
+                                   request.max_rank)
+            return rand_english_word(request.word_size)
+        except ValueError:
+            raise endpoints.BadRequestException('No target words of requested '
+                                                'length and difficulty '
+                                                'available!')
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @ndb.synctasklet
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield gamecache.get_game_async(request.urlsafe_game_key)
         if game:
             if game.game_deleted:
                 raise endpoints.ForbiddenException ('game has been deleted')
-            return game.to_form('Time to make a move!')
+            names = yield get_user_names_async([game.user])
+            raise ndb.Return(game.to_form('Time to make a move!',
+                                          names.get(game.user)))
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GET_GAMES_REQUEST,
+                      response_message=UserGames,
+                      path='games',
+                      name='get_games',
+                      http_method='GET')
+    @ndb.synctasklet
+    def get_games(self, request):
+        """Return the current state of several games, fetched in one batch.
+        Deleted games are included with game_deleted set."""
+        if len(request.urlsafe_game_keys) > MAX_BULK_GAMES:
+            raise endpoints.BadRequestException(
+                    'At most {} games can be fetched at once.'.format(
+                                                                MAX_BULK_GAMES))
+        # Games in play may have newer moves in the session cache, which is
+        # read alongside the datastore.
+        games = yield gamecache.get_games_async(request.urlsafe_game_keys)
+        if None in games:
+            raise endpoints.NotFoundException('Game not found!')
+        names = yield get_user_names_async([game.user for game in games])
+        raise ndb.Return(UserGames(items=[game.to_form('Time to make a move!',
+                                                       names.get(game.user))
+                                          for game in games]))
+
     @endpoints.method(request_message=GET_GAME_HISTORY,
                       response_message=GameHistory,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @ndb.synctasklet
     def get_game_history(self, request):
         """Return the historical game moves."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield gamecache.get_game_async(request.urlsafe_game_key)
         if game:
-            return game.to_history_form()
+            raise ndb.Return(game.to_history_form())
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GET_HINT_REQUEST,
+                      response_message=HintForm,
+                      path='game/hint/{urlsafe_game_key}',
+                      name='get_hint',
+                      http_method='GET')
+    @ndb.synctasklet
+    def get_hint(self, request):
+        """Return how many dictionary words still fit a game in progress,
+        and the unguessed letter that best splits them."""
+        game = yield gamecache.get_game_async(request.urlsafe_game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.ForbiddenException(
+                                        'Illegal action: Game is already over.')
+        state = game.get_state()
+        pattern = ''.join(state.masked())
+        remaining, letter, information = candidates.hint(pattern,
+                                                         state.missed())
+        raise ndb.Return(HintForm(pattern=pattern, remaining=remaining,
+                                  letter=letter, information=information))
+
     @endpoints.method(request_message=DEL_GAME_REQUEST,
                       response_message=GameForm,
                       path='del_game/{urlsafe_game_key}',
@@ -148,18 +300,27 @@ class PaulsHangmanApi(remote.Service):
                       http_method='PUT')
     def del_game(self, request):
         """Delete a game in progress from the DB."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if not game.game_over:
-                game.game_deleted = True
-                game.game_over = True
-                game.put()
-                return game.to_form('Game Deleted')
-            else:
+        # Load through the session cache so that moves not yet written back
+        # are kept, then write the game through and drop it from the cache.
+        # Retried like a move when another move on the game got in first.
+        for attempt in range(gamecache.CAS_RETRIES):
+            session = gamecache.load(request.urlsafe_game_key)
+            if not session:
+                raise endpoints.NotFoundException('Game not found!')
+            game = session.game
+            if game.game_over:
                 raise endpoints.ForbiddenException(
                                                 'Cannot delete completed games')
+            game.game_deleted = True
+            game.game_over = True
+            if session.save(flush=True):
+                break
         else:
-            raise endpoints.NotFoundException('Game not found!')
+            raise endpoints.ConflictException(
+                                    'Too many concurrent moves, try again.')
+        gamecache.evict(request.urlsafe_game_key)
+        Game.count_active(games=-1, tries=-game.tries_remaining)
+        return game.to_form('Game Deleted', get_user_name(game.user))
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
@@ -169,48 +330,126 @@ class PaulsHangmanApi(remote.Service):
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
 
-        # check pre-existing game state:
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        # Moves are applied to the cached game with compare-and-set, and
+        # retried when another move on the same game got in first.
+        with metrics.phase('apply'):
+            for attempt in range(gamecache.CAS_RETRIES):
+                session = gamecache.load(request.urlsafe_game_key)
+                # check pre-existing game state:
+                if not session:
+                    raise endpoints.NotFoundException('Game not found!')
+                game = session.game
+                outcome, msg = self._apply_guess(game, request.guess)
+                session.record_move()
+                # A finished game is written through by end_game instead.
+                if session.save(flush=session.needs_flush() and
+                                not game.game_over):
+                    break
+            else:
+                raise endpoints.ConflictException(
+                                        'Too many concurrent moves, try again.')
+
+        with metrics.phase('aggregates'):
+            if game.game_over:
+                self._end_game(game, outcome, request.urlsafe_game_key)
+            if outcome == MISS:
+                Game.count_active(tries=-1)
+        if outcome == WIN:
+            msg = '{msg} You win, the word was {solution}'.format(
+                                                        msg=msg,
+                                                        solution=game.game_word)
+        elif game.game_over:
+            msg += ' Game over!'
+        return game.to_form(msg, get_user_name(game.user))
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MoveResults,
+                      path='game/moves/{urlsafe_game_key}',
+                      name='make_moves',
+                      http_method='PUT')
+    def make_moves(self, request):
+        """Makes several moves in order, stopping when the game is over.
+        Returns the outcome of each applied guess and the final game state"""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses supplied.')
+        for guess in request.guesses:
+            if not guess.isalpha():
+                raise endpoints.ForbiddenException(
+                                        'Illegal action: Only a-z allowed')
+
+        # All guesses are applied in memory and written once, the whole batch
+        # is retried if another move on the same game got in first.
+        for attempt in range(gamecache.CAS_RETRIES):
+            session = gamecache.load(request.urlsafe_game_key)
+            if not session:
+                raise endpoints.NotFoundException('Game not found!')
+            game = session.game
+            # Every letter and every try is enough to finish any game,
+            # longer batches would only grow the move log.
+            if len(request.guesses) > MAX_LETTERS + game.max_tries:
+                raise endpoints.BadRequestException(
+                        'At most {} guesses can be made at once.'.format(
+                                                MAX_LETTERS + game.max_tries))
+            results = []
+            for guess in request.guesses:
+                outcome, msg = self._apply_guess(game, guess)
+                results.append(MoveResult(guess=guess, outcome=outcome,
+                                          message=msg))
+                if game.game_over:
+                    break
+            if session.save(flush=not game.game_over):
+                break
+        else:
+            raise endpoints.ConflictException(
+                                    'Too many concurrent moves, try again.')
+
+        if game.game_over:
+            self._end_game(game, outcome, request.urlsafe_game_key)
+        Game.count_active(tries=-len([result for result in results
+                                      if result.outcome == MISS]))
+        if outcome == WIN:
+            msg = 'You win, the word was {}'.format(game.game_word)
+        elif game.game_over:
+            msg = 'Game over!'
+        return MoveResults(items=results,
+                           game=game.to_form(msg, get_user_name(game.user)))
+
+    @staticmethod
+    def _end_game(game, outcome, urlsafe_game_key):
+        """Finishes a game that a move has ended, writing it through to the
+        datastore, and drops it from the session cache. The cache is dropped
+        even if end_game fails, so the game is read back from the datastore
+        rather than left finished without a Score."""
+        try:
+            ended = game.end_game(outcome == WIN)
+        finally:
+            gamecache.evict(urlsafe_game_key)
+        if not ended:
+            raise endpoints.ForbiddenException(
+                                        'Illegal action: Game is already over.')
+
+    @staticmethod
+    def _apply_guess(game, guess):
+        """Applies a guess to game in memory. Returns the outcome and a
+        message for the player. Sets game_over when the game has been won or
+        lost; the caller finishes it with end_game."""
         if game.game_over:
             raise endpoints.ForbiddenException(
                                         'Illegal action: Game is already over.')
         if game.game_deleted:
             raise endpoints.ForbiddenException(
                                         'Illegal action: Game is deleted.')
-        if not request.guess.isalpha():
+        if not guess.isalpha():
             raise endpoints.ForbiddenException(
                                         'Illegal action: Only a-z allowed')
 
-        # init completness tracker on first valid guess:
-        if game.current_guesses == []:
-            completed_letters = []  # init success tracking
-            for i in game.game_word:
-                completed_letters.append('_')
-            game.current_guesses = completed_letters[:-1] # remove newline char
-
-        ## Track all moves in the datastore:
-        # process new moves:
-        move_outcome = 'Correct Guess: False'
-        if request.guess == game.game_word or request.guess in game.game_word:
-            move_outcome = 'Correct Guess: True'
-        move = '(Player Guess: {0} {1})'.format(request.guess, move_outcome)
-        game.move_history.append(move)
-
-        # process a correct guess.
-        request.guess = request.guess.lower()
-        if not request.guess == game.game_word and request.guess in game.game_word:
-            # check each letter against each position, update completness
-            # tracking in the current_guesses list:
-            if request.guess == game.game_word[:-1]:
-                game.current_guesses = ['winner']
-            else:
-                for char in game.game_word:
-                    count = 0
-                    while count < len(game.current_guesses):
-                        if request.guess == game.game_word[count]:
-                            game.current_guesses[count] = request.guess
-                        count += 1
-            msg = 'correct guess! {}'.format(game.current_guesses)
+        # The guess is tracked in the game state's move log.
+        state = game.get_state()
+        outcome = state.guess(guess.lower())
+        game.set_state(state)
+
+        if outcome != MISS:
+            msg = 'correct guess! {}'.format(state.masked())
 
         # process a failed request
         else:
@@ -219,29 +458,24 @@ class PaulsHangmanApi(remote.Service):
             msg = 'Wrong guess, {} tries remaining'.format(game.tries_remaining)
 
         # handle end game state.
-        if game.tries_remaining < 1:
-            game.end_game(False)
-            game.move_history.append('Failed to guess word, Game Over!')
-            game.put()
-            return game.to_form(msg + ' Game over!')
-
-        # As the game progresses, the _ are removed from the current_guesses
-        # list. The absence of an _ indicates a final guess was succesful.
-        if '_' not in game.current_guesses:
-            game.end_game(True)
-            msg = '{msg} You win, the word was {solution}'.format(
-                                                        msg=msg,
-                                                        solution=game.game_word)
-        game.put()
-        return game.to_form(msg)
+        if game.tries_remaining < 1 or outcome == WIN:
+            game.game_over = True
+        return outcome, msg
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @ndb.synctasklet
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return all scores, one page at a time"""
+        scores, next_cursor = yield fetch_page_async(Score.query(),
+                                                     request.page_size,
+                                                     request.cursor)
+        forms = yield self._score_forms_async(scores)
+        forms.next_cursor = next_cursor
+        raise ndb.Return(forms)
 
 ################################################################################
     ### Game Ranking Methods ###
@@ -256,28 +490,41 @@ class PaulsHangmanApi(remote.Service):
            higher than a complete game with less tries remaining. A correct
            guess does not reduce tries_remaining."""
 
+        if request.number_of_results is not None and \
+                request.number_of_results < 1:
+            raise endpoints.BadRequestException(
+                    'number_of_results must be positive.')
+        # Served from the maintained top scores of the requested window.
+        try:
+            window_id = Leaderboard.window_id(request.window or 'all',
+                                              date.today())
+        except ValueError:
+            raise endpoints.BadRequestException(
+                    'window must be one of all, day or week.')
+        entries = Leaderboard.get_entries(window_id)
         # Catch no games finished:
-        scores = Score.query(Score.won == True).order(-Score.points)
-        if not scores:
+        if not entries:
             raise endpoints.NotFoundException(
                     'No Games exist.')
         # Optionally limit results to passed in param.
-        scores = scores.fetch(limit=request.number_of_results)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        entries = entries[:request.number_of_results or LEADERBOARD_SIZE]
+        return ScoreForms(items=[entry.to_form() for entry in entries])
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @ndb.synctasklet
     def get_user_scores(self, request):
         """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = yield get_user_key_async(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores = yield queries.user_scores(user_key).fetch_async()
+        raise ndb.Return(ScoreForms(items=[score.to_form(request.user_name)
+                                           for score in scores]))
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
@@ -285,30 +532,64 @@ class PaulsHangmanApi(remote.Service):
                       http_method='GET')
     def get_average_attempts(self, request):
         """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
+        message = memcache.get(MEMCACHE_MOVES_REMAINING)
+        if message is None:
+            message = self._average_attempts_message()
+        return StringMessage(message=message)
 
-    @endpoints.method(response_message=UserRankings,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserRankings,
                       path='get_user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @ndb.synctasklet
     def ranking(self, request):
         """Return a global ranking. User ranking is updated at the end of each
            game"""
         # Return all users who have a completed_games, in order of ranking.
-        rankings = User.query().order(-User.ranking_score)
-        return UserRankings(
-                        items=[rank.to_rank_form() for rank in rankings])
+        # Only the name and ranking are needed, so a projection is enough.
+        rankings, next_cursor = yield fetch_page_async(
+                queries.rankings(), request.page_size, request.cursor)
+        raise ndb.Return(UserRankings(
+                        items=[rank.to_rank_form() for rank in rankings],
+                        next_cursor=next_cursor))
+
+    @staticmethod
+    @ndb.tasklet
+    def _score_forms_async(scores):
+        """Returns ScoreForms for a list of Scores, resolving all of their
+        user names with one batch lookup."""
+        names = yield get_user_names_async([score.user for score in scores])
+        raise ndb.Return(ScoreForms(items=[score.to_form(names.get(score.user))
+                                           for score in scores]))
+
+    @staticmethod
+    def _average_attempts_message():
+        """Returns the average moves remaining of active Games, read from the
+        sharded counters that new_game, make_move, del_game and end_game
+        keep up to date."""
+        totals = counters.get_counts([ACTIVE_GAMES_COUNTER,
+                                      ACTIVE_TRIES_COUNTER])
+        count = totals[ACTIVE_GAMES_COUNTER]
+        if count < 1:
+            return ''
+        average = float(totals[ACTIVE_TRIES_COUNTER])/count
+        return 'The average moves remaining is {:.2f}'.format(average)
 
     @staticmethod
     def _cache_average_attempts():
         """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_tries_remaining = sum([game.tries_remaining
-                                        for game in games])
-            average = float(total_tries_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
+        memcache.set(MEMCACHE_MOVES_REMAINING,
+                     PaulsHangmanApi._average_attempts_message())
+
+    @staticmethod
+    def _reconcile_average_attempts():
+        """Recounts the active Games and their tries remaining with a full
+        scan, and resets the counters to match."""
+        games = queries.active_game_tries().fetch()
+        counters.reset({ACTIVE_GAMES_COUNTER: len(games),
+                        ACTIVE_TRIES_COUNTER: sum([game.tries_remaining
+                                                   for game in games])})
+        PaulsHangmanApi._cache_average_attempts()
 
 api = endpoints.api_server([PaulsHangmanApi])
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Load benchmark of the API hot paths. PaulsHangmanApi methods
+are run in process against the App Engine testbed stubs for the datastore,
+memcache and the task queue, over a generated population of users and games.
+Reports ops/sec, p50/p99 latency and RPCs per call for each endpoint.
+
+The population and the sequence of calls are seeded, so RPC counts are
+exactly repeatable and latencies are comparable between runs on one machine.
+Save a run with --output and compare a later one against it with --baseline,
+which exits non-zero when an endpoint makes more RPCs per call or its p99
+latency grows by more than --tolerance.
+
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \
+        --output before.json
+    python benchmark.py --sdk ... --baseline before.json
+
+With --startup, times instance start up instead: each of --startup-runs
+fresh interpreters imports the API (or only gamefunc without an SDK), loads
+the word index and features and answers a first hint, the work a cold
+instance does before its first new_game or get_hint completes."""
+
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ('new_game', 'make_move', 'get_game', 'get_user_games',
+             'leader_board', 'ranking')
+# Start up steps under this much slower than the baseline are noise.
+STARTUP_NOISE_MS = 5.0
+
+# Run in a fresh interpreter by run_startup, prints {step: milliseconds}.
+_STARTUP_SCRIPT = '''
+import json, sys, time
+timings = {}
+def step(name, function):
+    start = time.time()
+    function()
+    timings[name] = (time.time() - start) * 1000
+sdk = sys.argv[1]
+if sdk:
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, '')
+    step('import api', lambda: __import__('api'))
+else:
+    step('import gamefunc', lambda: __import__('gamefunc'))
+import gamefunc, candidates
+step('load_index', gamefunc.load_index)
+step('load_features', gamefunc.load_features)
+step('first hint', lambda: candidates.hint('_____', ''))
+print json.dumps(timings)
+'''
+
+
+def _fix_sys_path(sdk):
+    """Puts the App Engine SDK and its bundled libraries on sys.path"""
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, BASE_DIR)
+
+
+class RpcCounter(object):
+    """Counts API calls by 'service.method' through an apiproxy pre-call
+    hook, which sees both synchronous and asynchronous RPCs."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+                'benchmark_rpc_counter', self._hook)
+
+    def _hook(self, service, call, request, response):
+        self.counts['{}.{}'.format(service, call)] += 1
+
+    def reset(self):
+        self.counts.clear()
+
+
+def _setup_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='pauls-hangman', overwrite=True)
+    # Queries see every write, as they would once indexes have caught up.
+    bed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util
+            .PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=BASE_DIR)
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    return bed
+
+
+def _call(api, name, **fields):
+    """Calls an API method with a request built from fields. The protorpc
+    and endpoints wrappers are skipped, they make no RPCs."""
+    info = getattr(api, name).remote
+    return info.method(api, info.request_type(**fields))
+
+
+class Population(object):
+    """The users and games the benchmark calls are made against"""
+
+    def __init__(self, api, rng, users, games_per_user, word_size, attempts):
+        self.api = api
+        self.rng = rng
+        self.word_size = word_size
+        self.attempts = attempts
+        self.user_names = ['player{}'.format(i) for i in range(users)]
+        # urlsafe key -> letters guessed so far, for the active games.
+        self.games = {}
+        for name in self.user_names:
+            _call(api, 'create_user', user_name=name,
+                  email='{}@example.com'.format(name))
+            for i in range(games_per_user):
+                self.new_game(name)
+        # Finish a third of the games, so there are scores and rankings.
+        for urlsafe in self.rng.sample(sorted(self.games),
+                                       len(self.games) // 3):
+            while urlsafe in self.games:
+                self.guess(urlsafe)
+
+    def new_game(self, user_name=None):
+        form = _call(self.api, 'new_game',
+                     user_name=user_name or self.rng.choice(self.user_names),
+                     word_size=self.word_size, attempts=self.attempts)
+        self.games[form.urlsafe_key] = set()
+        return form
+
+    def game(self):
+        """Returns the urlsafe key of a random active game"""
+        if not self.games:
+            self.new_game()
+        return self.rng.choice(sorted(self.games))
+
+    def next_guess(self, urlsafe):
+        guessed = self.games[urlsafe]
+        letter = self.rng.choice([letter for letter in string.ascii_lowercase
+                                  if letter not in guessed])
+        guessed.add(letter)
+        return letter
+
+    def moved(self, urlsafe, form):
+        """Notes the result of a move, replacing a finished game"""
+        if form.game_over:
+            del self.games[urlsafe]
+
+    def guess(self, urlsafe):
+        form = _call(self.api, 'make_move', urlsafe_game_key=urlsafe,
+                     guess=self.next_guess(urlsafe))
+        self.moved(urlsafe, form)
+
+
+def _operations(population):
+    """Returns {endpoint: prepare}. prepare() is called outside the timed
+    section and returns (fields, after), after being called with the
+    response, or None."""
+    rng = population.rng
+
+    def new_game():
+        return dict(user_name=rng.choice(population.user_names),
+                    word_size=population.word_size,
+                    attempts=population.attempts), \
+            lambda form: population.games.setdefault(form.urlsafe_key, set())
+
+    def make_move():
+        urlsafe = population.game()
+        return dict(urlsafe_game_key=urlsafe,
+                    guess=population.next_guess(urlsafe)), \
+            lambda form: population.moved(urlsafe, form)
+
+    def get_game():
+        return dict(urlsafe_game_key=population.game()), None
+
+    def get_user_games():
+        return dict(user_name=rng.choice(population.user_names)), None
+
+    def leader_board():
+        return dict(window=rng.choice(['all', 'day', 'week'])), None
+
+    def ranking():
+        return {}, None
+
+    return {'new_game': new_game, 'make_move': make_move,
+            'get_game': get_game, 'get_user_games': get_user_games,
+            'leader_board': leader_board, 'ranking': ranking}
+
+
+def _percentile(ordered, fraction):
+    """Nearest rank percentile of a sorted list"""
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def run(args):
+    """Runs the benchmark and returns the results as a JSON-able dict"""
+    _fix_sys_path(args.sdk)
+    bed = _setup_testbed()
+    try:
+        from google.appengine.ext import ndb
+        from api import PaulsHangmanApi
+
+        api = PaulsHangmanApi()
+        rng = random.Random(args.seed)
+        population = Population(api, rng, args.users, args.games,
+                                args.word_size, args.attempts)
+        operations = _operations(population)
+        counter = RpcCounter()
+        counter.install()
+
+        results = {}
+        for name in args.endpoints:
+            latencies = []
+            rpcs = collections.Counter()
+            for i in range(args.ops):
+                fields, after = operations[name]()
+                # Each call starts with an empty in-context cache, as a new
+                # request would. Instance and memcache caches stay warm.
+                ndb.get_context().clear_cache()
+                counter.reset()
+                start = time.time()
+                response = _call(api, name, **fields)
+                latencies.append(time.time() - start)
+                rpcs.update(counter.counts)
+                if after:
+                    after(response)
+            latencies.sort()
+            total = sum(latencies)
+            results[name] = {
+                'ops': args.ops,
+                'ops_per_sec': args.ops / total if total else 0.0,
+                'p50_ms': _percentile(latencies, 0.5) * 1000,
+                'p99_ms': _percentile(latencies, 0.99) * 1000,
+                'rpcs_per_op': dict((call, float(count) / args.ops)
+                                    for call, count in rpcs.iteritems()),
+            }
+    finally:
+        bed.deactivate()
+
+    return {'commit': _commit(),
+            'config': {'users': args.users, 'games': args.games,
+                       'ops': args.ops, 'seed': args.seed,
+                       'word_size': args.word_size,
+                       'attempts': args.attempts},
+            'results': results}
+
+
+def run_startup(args):
+    """Times start up in fresh interpreters and returns the results as a
+    JSON-able dict"""
+    runs = collections.defaultdict(list)
+    for i in range(args.startup_runs):
+        output = subprocess.check_output(
+                [sys.executable, '-c', _STARTUP_SCRIPT, args.sdk or ''],
+                cwd=BASE_DIR)
+        for step, ms in json.loads(output.splitlines()[-1]).iteritems():
+            runs[step].append(ms)
+    startup = {}
+    for step, timings in runs.iteritems():
+        timings.sort()
+        startup[step] = {'min_ms': timings[0],
+                         'median_ms': _percentile(timings, 0.5),
+                         'max_ms': timings[-1]}
+    return {'commit': _commit(),
+            'config': {'startup_runs': args.startup_runs,
+                       'sdk': bool(args.sdk)},
+            'startup': startup}
+
+
+def report_startup(run_results):
+    print 'commit {commit}  config {config}'.format(**run_results)
+    print '{:<16}{:>10}{:>12}{:>10}'.format('step', 'min ms', 'median ms',
+                                            'max ms')
+    startup = run_results['startup']
+    for step in sorted(startup, key=lambda step: -startup[step]['median_ms']):
+        print '{:<16}{:>10.2f}{:>12.2f}{:>10.2f}'.format(
+                step, startup[step]['min_ms'], startup[step]['median_ms'],
+                startup[step]['max_ms'])
+    print '{:<16}{:>10.2f}{:>12.2f}'.format(
+            'total',
+            sum(timing['min_ms'] for timing in startup.itervalues()),
+            sum(timing['median_ms'] for timing in startup.itervalues()))
+
+
+def compare_startup(run_results, baseline, tolerance):
+    """Prints the change from a baseline start up run. Returns the list of
+    regressions, steps whose fastest run grew by more than tolerance and by
+    more than STARTUP_NOISE_MS. The fastest run is the least disturbed by
+    whatever else the machine is doing."""
+    regressions = []
+    for step, timing in sorted(run_results['startup'].iteritems()):
+        before = baseline.get('startup', {}).get(step)
+        if before is None:
+            continue
+        growth = timing['min_ms'] - before['min_ms']
+        print '{:<16} min {:.2f} -> {:.2f} ms'.format(
+                step, before['min_ms'], timing['min_ms'])
+        if growth > STARTUP_NOISE_MS and \
+                growth > before['min_ms'] * tolerance:
+            regressions.append('{}: start up {:.2f} ms slower'.format(
+                                                                step, growth))
+    return regressions
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=BASE_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(run_results):
+    print 'commit {commit}  config {config}'.format(**run_results)
+    print '{:<16}{:>10}{:>10}{:>10}{:>8}  {}'.format(
+            'endpoint', 'ops/sec', 'p50 ms', 'p99 ms', 'rpcs', 'by call')
+    for name, result in sorted(run_results['results'].iteritems()):
+        rpcs = result['rpcs_per_op']
+        print '{:<16}{:>10.1f}{:>10.2f}{:>10.2f}{:>8.2f}  {}'.format(
+                name, result['ops_per_sec'], result['p50_ms'],
+                result['p99_ms'], sum(rpcs.itervalues()),
+                ', '.join('{} {:.2f}'.format(call, count)
+                          for call, count in sorted(rpcs.iteritems())))
+
+
+def compare(run_results, baseline, tolerance):
+    """Prints the change from a baseline run. Returns the list of
+    regressions, an endpoint making more RPCs per call or with a p99
+    latency more than tolerance above the baseline."""
+    if baseline['config'] != run_results['config']:
+        print 'Warning: baseline was run with {}'.format(baseline['config'])
+    regressions = []
+    for name, result in sorted(run_results['results'].iteritems()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        rpcs = sum(result['rpcs_per_op'].itervalues())
+        rpcs_before = sum(before['rpcs_per_op'].itervalues())
+        p99_change = (result['p99_ms'] / before['p99_ms'] - 1
+                      if before['p99_ms'] else 0.0)
+        print '{:<16} rpcs {:.2f} -> {:.2f}  p99 {:+.0%}'.format(
+                name, rpcs_before, rpcs, p99_change)
+        if rpcs > rpcs_before + 1e-9:
+            regressions.append('{}: {:.2f} more RPCs per call'.format(
+                                                    name, rpcs - rpcs_before))
+        if p99_change > tolerance:
+            regressions.append('{}: p99 latency up {:.0%}'.format(
+                                                            name, p99_change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine SDK (google_appengine)')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--games', type=int, default=4,
+                        help='games created per user before the run')
+    parser.add_argument('--ops', type=int, default=200,
+                        help='calls made to each endpoint')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--word-size', type=int, default=5)
+    parser.add_argument('--attempts', type=int, default=8)
+    parser.add_argument('--endpoints', nargs='+', default=list(ENDPOINTS),
+                        choices=ENDPOINTS)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='compare with a saved run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p99 or start up growth over the baseline')
+    parser.add_argument('--startup', action='store_true',
+                        help='time instance start up instead of endpoints')
+    parser.add_argument('--startup-runs', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.startup:
+        results = run_startup(args)
+        report_startup(results)
+        check = compare_startup
+    else:
+        results = run(args)
+        report(results)
+        check = compare
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = check(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION {}'.format(regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""candidates.py - Filtering of the dictionary words still consistent with a
+game in progress, and choice of the letter that best splits them. With NumPy
+the words of each length are held as a character matrix and each filter or
+letter count is a handful of vectorised operations; without it the same
+results are computed with plain Python loops. Results are memoised per
+(length, pattern, misses) state, as many games pass through the same states.
+
+A state is described the way a player sees it: the pattern of revealed
+letters with '_' for hidden positions, and the letters guessed that are not
+in the word."""
+
+import math
+import string
+
+import gamefunc
+
+# NumPy is imported on the first hint rather than with this module, to keep
+# it off the instance start up path. False until the import is tried.
+numpy = False
+_matrices = {}
+_hints = {}
+_HINT_CACHE_SIZE = 4096
+# Entropies closer than this are a tie, broken by the earlier letter, so
+# that rounding differences between the two paths cannot change the hint.
+_TOLERANCE = 1e-9
+
+
+def _consistent(word, pattern, guessed, misses):
+    """Returns True if word could be the target word of a state"""
+    for char, shown in zip(word, pattern):
+        if shown == '_':
+            # Every occurrence of a guessed letter is revealed.
+            if char in guessed:
+                return False
+        elif char != shown:
+            return False
+    return not misses.intersection(word)
+
+
+def _split_entropy(signatures):
+    """Returns the entropy in bits of a list of outcome counts"""
+    total = float(sum(signatures))
+    return -sum(n / total * math.log(n / total, 2) for n in signatures if n)
+
+
+class WordMatrix(object):
+    """The words of one length as an (words, length) uint8 matrix, with an
+    (words, 26) matrix of which letters each word contains."""
+
+    def __init__(self, length, index=None):
+        index = index or gamefunc.load_index()
+        self.length = length
+        self.words = numpy.frombuffer(index.bucket(length),
+                                      dtype=numpy.uint8).reshape(-1, length)
+        letters = numpy.arange(ord('a'), ord('z') + 1, dtype=numpy.uint8)
+        self.contains = (self.words[:, :, None] ==
+                         letters[None, None, :]).any(axis=1)
+        self._weights = 1 << numpy.arange(length, dtype=numpy.int64)
+
+    def matches(self, pattern, misses):
+        """Returns a boolean array marking the words consistent with a
+        state"""
+        guessed = [ord(char) for char in pattern if char != '_']
+        guessed.extend(ord(char) for char in misses)
+        keep = numpy.ones(len(self.words), dtype=bool)
+        for i, shown in enumerate(pattern):
+            column = self.words[:, i]
+            if shown == '_':
+                if guessed:
+                    keep &= ~numpy.in1d(column, guessed)
+            else:
+                keep &= column == ord(shown)
+        if misses:
+            keep &= ~self.contains[:, [ord(char) - ord('a')
+                                      for char in misses]].any(axis=1)
+        return keep
+
+    def best_letter(self, keep, guessed):
+        """Returns (letter, entropy) for the unguessed letter whose positions
+        in the candidate words split them into the most even groups, or
+        (None, 0.0) when no letter tells them apart. Ties go to the earlier
+        letter."""
+        candidates = self.words[keep]
+        present = self.contains[keep].sum(axis=0)
+        best, best_entropy = None, 0.0
+        for i, letter in enumerate(string.ascii_lowercase):
+            if letter in guessed or not present[i]:
+                continue
+            # Group the candidates by where the letter appears in them.
+            signatures = ((candidates == ord(letter)) *
+                          self._weights).sum(axis=1)
+            inverse = numpy.unique(signatures, return_inverse=True)[1]
+            entropy = _split_entropy(numpy.bincount(inverse).tolist())
+            if entropy > best_entropy + _TOLERANCE:
+                best, best_entropy = letter, entropy
+        return best, best_entropy
+
+
+def _load_numpy():
+    """Imports NumPy on first use. Returns the module, or None when it is
+    not installed."""
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def _matrix(length):
+    matrix = _matrices.get(length)
+    if matrix is None:
+        matrix = _matrices[length] = WordMatrix(length)
+    return matrix
+
+
+def _hint_numpy(pattern, misses):
+    matrix = _matrix(len(pattern))
+    keep = matrix.matches(pattern, misses)
+    remaining = int(keep.sum())
+    letter, entropy = matrix.best_letter(keep, set(pattern) | set(misses))
+    return remaining, letter, entropy
+
+
+def _hint_python(pattern, misses):
+    index = gamefunc.load_index()
+    length = len(pattern)
+    guessed = set(pattern) | set(misses)
+    guessed.discard('_')
+    misses = set(misses)
+    candidates = [word for word in (index.word(length, i)
+                                    for i in range(index.count(length)))
+                  if _consistent(word, pattern, guessed, misses)]
+    present = set()
+    for word in candidates:
+        present.update(word)
+    best, best_entropy = None, 0.0
+    for letter in string.ascii_lowercase:
+        # As in WordMatrix.best_letter, letters in none of the candidates
+        # are skipped.
+        if letter in guessed or letter not in present:
+            continue
+        groups = {}
+        for word in candidates:
+            signature = tuple(i for i, char in enumerate(word)
+                              if char == letter)
+            groups[signature] = groups.get(signature, 0) + 1
+        entropy = _split_entropy(groups.values())
+        if entropy > best_entropy + _TOLERANCE:
+            best, best_entropy = letter, entropy
+    return len(candidates), best, best_entropy
+
+
+def warm(lengths):
+    """Imports NumPy and builds the word matrices of the given lengths, so
+    the first hints do not pay for it."""
+    if _load_numpy() is not None:
+        for length in lengths:
+            if gamefunc.load_index().count(length):
+                _matrix(length)
+
+
+def hint(pattern, misses):
+    """Returns (remaining, letter, entropy) for a state: the number of words
+    still consistent with it, the unguessed letter that splits them best
+    (None if no letter does) and the expected information from guessing it,
+    in bits.
+    Args:
+        pattern: The revealed letters of the word, '_' for hidden ones.
+        misses: The guessed letters that are not in the word."""
+    pattern = ''.join(pattern)
+    misses = ''.join(sorted(set(misses)))
+    key = (len(pattern), pattern, misses)
+    result = _hints.get(key)
+    if result is None:
+        if _load_numpy() is not None:
+            result = _hint_numpy(pattern, misses)
+        else:
+            result = _hint_python(pattern, misses)
+        if len(_hints) > _HINT_CACHE_SIZE:
+            _hints.clear()
+        _hints[key] = result
+    return result
@@ -0,0 +1,119 @@
+"""counters.py - Sharded counters. A counter is split over several shard
+entities so that frequent updates do not contend on one entity group, and its
+total is cached in memcache."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+DEFAULT_SHARDS = 20
+MEMCACHE_COUNTER = 'COUNTER:{}'
+# Cached totals are kept up to date with incr and decr, which miss updates
+# that land while a total is being summed. They expire so that any such
+# drift is corrected by the next sum.
+CACHE_SECONDS = 60
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter. The key id is '<name>:<shard number>'"""
+    count = ndb.IntegerProperty(required=True, default=0)
+
+
+def _shard_keys(name, shards):
+    return [ndb.Key(CounterShard, '{}:{}'.format(name, i))
+            for i in range(shards)]
+
+
+def get_count(name, shards=DEFAULT_SHARDS):
+    """Returns the total of a counter, summing its shards on a cache miss"""
+    cache_id = MEMCACHE_COUNTER.format(name)
+    total = memcache.get(cache_id)
+    if total is None:
+        total = sum(shard.count for shard in ndb.get_multi(
+                                        _shard_keys(name, shards)) if shard)
+        memcache.add(cache_id, total, time=CACHE_SECONDS)
+    return total
+
+
+def get_counts(names, shards=DEFAULT_SHARDS, cached=True):
+    """Returns a dict of counter name -> total, reading every uncached counter
+    with a single get_multi. With cached=False every total is summed from
+    its shards, for callers that store the totals elsewhere."""
+    totals = {}
+    if cached:
+        cache_ids = dict((MEMCACHE_COUNTER.format(name), name)
+                         for name in names)
+        totals = dict((cache_ids[cache_id], total) for cache_id, total in
+                      memcache.get_multi(cache_ids.keys()).iteritems())
+    missing = [name for name in names if name not in totals]
+    if missing:
+        keys = []
+        for name in missing:
+            keys.extend(_shard_keys(name, shards))
+        shard_counts = ndb.get_multi(keys)
+        for i, name in enumerate(missing):
+            totals[name] = sum(shard.count for shard in
+                               shard_counts[i * shards:(i + 1) * shards]
+                               if shard)
+        memcache.add_multi(dict((MEMCACHE_COUNTER.format(name), totals[name])
+                                for name in missing), time=CACHE_SECONDS)
+    return totals
+
+
+def increment(deltas, shards=DEFAULT_SHARDS):
+    """Adds to one or more counters.
+    Args:
+        deltas: dict of counter name -> amount to add, which may be negative
+        shards: the number of shards of the counters"""
+    increment_shards(deltas, shards)
+    update_cached(deltas)
+
+
+def increment_shards(deltas, shards=DEFAULT_SHARDS):
+    """Adds to a random shard of each counter without touching the cached
+    totals. Joins the caller's transaction if there is one, each counter
+    adding one entity group to it. Call update_cached with the same deltas
+    once the transaction has committed."""
+    deltas = dict((name, delta) for name, delta in deltas.iteritems() if delta)
+    if deltas:
+        _increment_shards(dict(
+            (random.choice(_shard_keys(name, shards)), delta)
+            for name, delta in deltas.iteritems()))
+
+
+def update_cached(deltas):
+    """Applies deltas written by increment_shards to the cached totals"""
+    for name, delta in deltas.iteritems():
+        # incr and decr leave an uncached total alone, it is summed on read.
+        # decr stops at 0, the total is corrected when it expires.
+        if delta > 0:
+            memcache.incr(MEMCACHE_COUNTER.format(name), delta)
+        elif delta < 0:
+            memcache.decr(MEMCACHE_COUNTER.format(name), -delta)
+
+
+@ndb.transactional(xg=True)
+def _increment_shards(deltas):
+    keys = deltas.keys()
+    shards = ndb.get_multi(keys)
+    for i, key in enumerate(keys):
+        if shards[i] is None:
+            shards[i] = CounterShard(key=key)
+        shards[i].count += deltas[key]
+    ndb.put_multi(shards)
+
+
+def reset(totals, shards=DEFAULT_SHARDS):
+    """Sets counters to the given totals, used to reconcile them with the
+    data they count.
+    Args:
+        totals: dict of counter name -> new total
+        shards: the number of shards of the counters"""
+    entities = []
+    for name, total in totals.iteritems():
+        keys = _shard_keys(name, shards)
+        entities.append(CounterShard(key=keys[0], count=total))
+        entities.extend(CounterShard(key=key, count=0) for key in keys[1:])
+    ndb.put_multi(entities)
+    memcache.delete_multi([MEMCACHE_COUNTER.format(name) for name in totals])
@@ -0,0 +1,175 @@
+"""gamecache.py - Session cache for games being played. A game in play is held
+in memcache and moves are applied to the cached copy with compare-and-set, so
+concurrent guesses on one game cannot overwrite each other. Moves are written
+back to the datastore when the game finishes or is deleted, after FLUSH_MOVES
+moves, or FLUSH_SECONDS after the first unwritten move. Only a request whose
+compare-and-set succeeded writes back, and the write is skipped when the
+datastore already holds a finished game or more moves."""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Game
+from utils import get_by_urlsafe, get_multi_by_urlsafe_async
+
+MEMCACHE_GAME = 'GAME:{}'
+FLUSH_MOVES = 5
+FLUSH_SECONDS = 30
+CAS_RETRIES = 5
+
+
+class GameSession(object):
+    """A game loaded through the cache.
+    Attributes:
+        game: The Game entity, including any moves not yet in the datastore.
+        dirty: The number of moves not yet in the datastore.
+        since: When the oldest unwritten move was made, or None."""
+
+    def __init__(self, urlsafe, game, dirty=0, since=None, client=None):
+        self.urlsafe = urlsafe
+        self.game = game
+        self.dirty = dirty
+        self.since = since
+        # The memcache client holding the CAS id, None if memcache is down.
+        self._client = client
+        self._flush_queued = False
+
+    def record_move(self):
+        """Notes a move applied to the cached game"""
+        self.dirty += 1
+        if self.since is None:
+            self.since = time.time()
+            self._flush_queued = True
+
+    def needs_flush(self):
+        """Returns True when the cached moves should be written back"""
+        return (self._client is None or self.game.game_over or
+                self.dirty >= FLUSH_MOVES or
+                (self.since is not None and
+                 time.time() - self.since >= FLUSH_SECONDS))
+
+    def save(self, flush=False):
+        """Stores the session back in memcache, then with flush=True writes
+        the game to the datastore. Returns False if the game was changed by
+        another request since it was loaded, in which case the caller should
+        load it again and retry."""
+        if flush:
+            self.dirty = 0
+            self.since = None
+            self._flush_queued = False
+        if self._client is not None and \
+                not self._client.cas(_cache_id(self.urlsafe), self._value()):
+            return False
+        if flush:
+            try:
+                written = self.game.write_back()
+            except Exception:
+                # The cache now claims the moves are written, so drop it and
+                # let the game be read back from the datastore.
+                evict(self.urlsafe)
+                raise
+            if not written:
+                # The datastore is ahead of the cache, retry from there.
+                evict(self.urlsafe)
+                return False
+        if self._flush_queued:
+            # Make sure a game left idle is still written back.
+            taskqueue.Queue().add_async(taskqueue.Task(
+                    url='/tasks/flush_game',
+                    params={'urlsafe_game_key': self.urlsafe},
+                    countdown=FLUSH_SECONDS))
+            self._flush_queued = False
+        return True
+
+    def _value(self):
+        return {'game': self.game, 'dirty': self.dirty, 'since': self.since}
+
+
+def _cache_id(urlsafe):
+    return MEMCACHE_GAME.format(urlsafe)
+
+
+def load(urlsafe):
+    """Returns a GameSession for the game, or None if it does not exist.
+    Raises the same errors as utils.get_by_urlsafe."""
+    client = memcache.Client()
+    cache_id = _cache_id(urlsafe)
+    value = client.gets(cache_id)
+    if value is None:
+        game = get_by_urlsafe(urlsafe, Game)
+        if game is None:
+            return None
+        client.add(cache_id, {'game': game, 'dirty': 0, 'since': None})
+        value = client.gets(cache_id)
+        if value is None:
+            return GameSession(urlsafe, game)
+    return GameSession(urlsafe, value['game'], value['dirty'], value['since'],
+                       client)
+
+
+def get_game(urlsafe):
+    """Returns the latest state of a game, including unwritten moves, or None
+    if it does not exist."""
+    return get_game_async(urlsafe).get_result()
+
+
+@ndb.tasklet
+def get_game_async(urlsafe):
+    """Tasklet version of get_game"""
+    value = yield ndb.get_context().memcache_get(_cache_id(urlsafe))
+    if value is not None:
+        raise ndb.Return(value['game'])
+    games = yield get_multi_by_urlsafe_async([urlsafe], Game)
+    raise ndb.Return(games[0])
+
+
+@ndb.tasklet
+def get_games_async(urlsafes):
+    """Returns the latest state of several games, reading memcache and the
+    datastore side by side. Missing games are None."""
+    context = ndb.get_context()
+    # Both lookups are started before either is waited on.
+    cache_futures = [context.memcache_get(_cache_id(urlsafe))
+                     for urlsafe in urlsafes]
+    games_future = get_multi_by_urlsafe_async(urlsafes, Game)
+    cached = yield cache_futures
+    games = yield games_future
+    raise ndb.Return([value['game'] if value is not None else game
+                      for value, game in zip(cached, games)])
+
+
+def overlay(games):
+    """Returns games with any that are in play replaced by their cached
+    copy, which may hold moves not yet in the datastore."""
+    return overlay_async(games).get_result()
+
+
+@ndb.tasklet
+def overlay_async(games):
+    """Tasklet version of overlay"""
+    context = ndb.get_context()
+    cached = yield [context.memcache_get(_cache_id(game.key.urlsafe()))
+                    for game in games]
+    raise ndb.Return([value['game'] if value is not None else game
+                      for value, game in zip(cached, games)])
+
+
+def evict(urlsafe):
+    """Drops a game from the cache, once it has been written back for good"""
+    memcache.delete(_cache_id(urlsafe))
+
+
+def flush(urlsafe):
+    """Writes back any unwritten moves of a cached game."""
+    for attempt in range(CAS_RETRIES):
+        client = memcache.Client()
+        value = client.gets(_cache_id(urlsafe))
+        if value is None or not value['dirty']:
+            return
+        session = GameSession(urlsafe, value['game'], value['dirty'],
+                              value['since'], client)
+        if session.save(flush=True):
+            return
@@ -1,28 +1,347 @@
 '''The file provides utility functions for the operation of the game.'''
+import bisect
+import logging
+import math
+import os
 import random
-import sys
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DICTIONARY_PATH = os.path.join(BASE_DIR, 'dictionary.dat')
+INDEX_PATH = os.path.join(BASE_DIR, 'dictionary.idx')
+
+# Index file layout (little endian):
+#   header:   magic, source size, source crc32, bucket count
+#   buckets:  (word length, word count, data offset, feature offset) per bucket
+#   data:     each bucket is its words packed back to back at a fixed width.
+#   features: per bucket, the WordFeatures columns of its words as arrays of
+#             FEATURE_TYPES, one after the other.
+INDEX_MAGIC = 'HMX2'
+_HEADER = struct.Struct('<4sIII')
+_BUCKET = struct.Struct('<IIII')
+# rank, entropy, distinct letters, rare letters, difficulty tier
+FEATURE_TYPES = ('I', 'f', 'B', 'B', 'B')
+
+
+class StaleIndexError(Exception):
+    """Raised when a prebuilt index does not match dictionary.dat"""
+
+
+def _source_signature(path=DICTIONARY_PATH):
+    """Returns the (size, crc32) pair used to tie an index to its word list"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return len(data), zlib.crc32(data) & 0xffffffff
+
+
+class WordIndex(object):
+    """Words from dictionary.dat grouped by length. Each bucket is a run of
+    fixed width words inside a single buffer, so a word is found by offset
+    arithmetic instead of a scan. The buffer is either a string built from
+    the word list or the contents of a prebuilt index file."""
+
+    def __init__(self, buf, buckets, signature, features=None):
+        self._buf = buf
+        # {length: (count, offset)}
+        self._buckets = buckets
+        self.signature = signature
+        # {length: WordFeatures columns} read from a prebuilt index, or None
+        self.features = features
+
+    @classmethod
+    def from_wordlist(cls, path=DICTIONARY_PATH):
+        """Builds the index from the plain text word list."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        signature = (len(data), zlib.crc32(data) & 0xffffffff)
+        grouped = {}
+        for word in data.split():
+            grouped.setdefault(len(word), []).append(word)
+        chunks = []
+        buckets = {}
+        offset = 0
+        for length in sorted(grouped):
+            words = grouped[length]
+            buckets[length] = (len(words), offset)
+            chunks.append(''.join(words))
+            offset += length * len(words)
+        return cls(''.join(chunks), buckets, signature)
+
+    @classmethod
+    def from_file(cls, path=INDEX_PATH):
+        """Loads a prebuilt index, including the word features, with a
+        single read of the file."""
+        with open(path, 'rb') as f:
+            buf = f.read()
+        magic, size, crc, count = _HEADER.unpack_from(buf, 0)
+        if magic != INDEX_MAGIC:
+            raise StaleIndexError('Unrecognised word index format')
+        buckets = {}
+        features = {}
+        for i in range(count):
+            length, words, offset, position = _BUCKET.unpack_from(
+                                        buf, _HEADER.size + i * _BUCKET.size)
+            buckets[length] = (words, offset)
+            columns = []
+            for typecode in FEATURE_TYPES:
+                column = array(typecode)
+                end = position + column.itemsize * words
+                column.fromstring(buf[position:end])
+                columns.append(column)
+                position = end
+            features[length] = tuple(columns)
+        return cls(buf, buckets, (size, crc), features)
+
+    def write(self, features, path=INDEX_PATH):
+        """Writes the index and the WordFeatures built from it in the
+        binary format read by from_file."""
+        position = _HEADER.size + len(self._buckets) * _BUCKET.size
+        table = []
+        data = []
+        for length in sorted(self._buckets):
+            count, offset = self._buckets[length]
+            data.append(self._buf[offset:offset + length * count])
+            table.append([length, count, position])
+            position += length * count
+        for entry in table:
+            entry.append(position)
+            for column in features.columns(entry[0]):
+                data.append(column.tostring())
+                position += column.itemsize * len(column)
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(INDEX_MAGIC, self.signature[0],
+                                 self.signature[1], len(self._buckets)))
+            for entry in table:
+                f.write(_BUCKET.pack(*entry))
+            f.write(''.join(data))
+
+    def verify(self, path=DICTIONARY_PATH):
+        """Raises StaleIndexError if the index was built from a different
+        word list than the one at path."""
+        if self.signature != _source_signature(path):
+            raise StaleIndexError('Word index is out of date with {}'.format(
+                                                                        path))
+
+    def count(self, length):
+        """Returns the number of words of the given length."""
+        return self._buckets.get(length, (0, 0))[0]
+
+    def word(self, length, position):
+        """Returns the word at position within the bucket for length."""
+        count, offset = self._buckets[length]
+        start = offset + position * length
+        return self._buf[start:start + length]
+
+    def bucket(self, length):
+        """Returns the words of the given length as one string, each word
+        taking length characters."""
+        count, offset = self._buckets.get(length, (0, 0))
+        return self._buf[offset:offset + length * count]
+
+    def random_word(self, length):
+        """Returns a random word of the given length. Raises ValueError when
+        there are no words of that length."""
+        count = self.count(length)
+        if not count:
+            raise ValueError('No words of length {}'.format(length))
+        return self.word(length, random.randrange(count))
+
+
+# Difficulty tiers, split into thirds of each word length by difficulty score.
+DIFFICULTY_TIERS = ('easy', 'medium', 'hard')
+# The least frequent letters in english text, which are rarely guessed early.
+RARE_LETTERS = frozenset('jkqvxz')
+
+WordStats = namedtuple('WordStats',
+                       'word rank entropy distinct rare difficulty tier')
+
+
+def _letter_entropy(word):
+    """Returns the Shannon entropy in bits of the letters in word"""
+    counts = {}
+    for char in word:
+        counts[char] = counts.get(char, 0) + 1
+    length = float(len(word))
+    return -sum((n / length) * math.log(n / length, 2)
+                for n in counts.itervalues())
+
+
+def _difficulty(length, rank, distinct, rare):
+    """Scores how hard a word is to guess. Repeated letters, rare letters and
+    uncommon words all make a word harder."""
+    return rare * 2.0 + (length - distinct) * 1.5 + rank / 2500.0
+
+
+class WordFeatures(object):
+    """Letter statistics for every word in the index. Words are referred to
+    by their position in the index bucket for their length. For each
+    (length, tier) the positions are kept in frequency order next to their
+    ranks, so a word within a rank limit is found with one bisect."""
+
+    def __init__(self, index, columns):
+        """columns is {length: (ranks, entropy, distinct, rare, tier_of)},
+        arrays of FEATURE_TYPES as stored in a prebuilt index."""
+        self.index = index
+        self._ranks = {}
+        self._entropy = {}
+        self._distinct = {}
+        self._rare = {}
+        self._tier_of = {}
+        # (length, tier) -> (positions, ranks), both in frequency order.
+        self._tiers = {}
+        for length, (ranks, entropy, distinct, rare, tier_of) in \
+                columns.iteritems():
+            self._ranks[length] = ranks
+            self._entropy[length] = entropy
+            self._distinct[length] = distinct
+            self._rare[length] = rare
+            self._tier_of[length] = tier_of
+            for tier_number, tier in enumerate(DIFFICULTY_TIERS):
+                positions = array('I', [i for i, word_tier in
+                                        enumerate(tier_of)
+                                        if word_tier == tier_number])
+                self._tiers[(length, tier)] = (
+                        positions, array('I', [ranks[i] for i in positions]))
+
+    @classmethod
+    def from_wordlist(cls, index, path=DICTIONARY_PATH):
+        """Computes the features of every word in the plain text word
+        list, which index must have been built from."""
+        with open(path, 'rb') as f:
+            words = f.read().split()
+        ranks, entropy, distinct, rare = {}, {}, {}, {}
+        for rank, word in enumerate(words):
+            length = len(word)
+            letters = set(word)
+            ranks.setdefault(length, array('I')).append(rank)
+            entropy.setdefault(length, array('f')).append(
+                                                    _letter_entropy(word))
+            distinct.setdefault(length, array('B')).append(len(letters))
+            rare.setdefault(length, array('B')).append(
+                                                len(letters & RARE_LETTERS))
+
+        columns = {}
+        for length, length_ranks in ranks.iteritems():
+            if len(length_ranks) != index.count(length):
+                raise StaleIndexError('Word index is out of date with {}'
+                                                            .format(path))
+            # Tiers are thirds of the words of a length by difficulty.
+            scores = sorted(range(len(length_ranks)),
+                            key=lambda i: _difficulty(length, length_ranks[i],
+                                                      distinct[length][i],
+                                                      rare[length][i]))
+            tier_of = array('B', [0] * len(scores))
+            size = len(scores)
+            for tier_number in range(len(DIFFICULTY_TIERS)):
+                start = size * tier_number // len(DIFFICULTY_TIERS)
+                end = size * (tier_number + 1) // len(DIFFICULTY_TIERS)
+                for position in scores[start:end]:
+                    tier_of[position] = tier_number
+            columns[length] = (length_ranks, entropy[length],
+                               distinct[length], rare[length], tier_of)
+        return cls(index, columns)
+
+    def columns(self, length):
+        """Returns the feature arrays of the words of a length, in
+        FEATURE_TYPES order."""
+        return (self._ranks[length], self._entropy[length],
+                self._distinct[length], self._rare[length],
+                self._tier_of[length])
+
+    def stats(self, length, position):
+        """Returns the WordStats for a word in the index."""
+        return WordStats(word=self.index.word(length, position),
+                         rank=self._ranks[length][position],
+                         entropy=self._entropy[length][position],
+                         distinct=self._distinct[length][position],
+                         rare=self._rare[length][position],
+                         difficulty=_difficulty(
+                                 length, self._ranks[length][position],
+                                 self._distinct[length][position],
+                                 self._rare[length][position]),
+                         tier=DIFFICULTY_TIERS[
+                                 self._tier_of[length][position]])
+
+    def random_position(self, length, tier=None, max_rank=None):
+        """Returns the position of a random word of the given length,
+        optionally limited to a difficulty tier and to the max_rank most
+        common words. Raises ValueError if nothing matches."""
+        if tier is None:
+            ranks = self._ranks.get(length, ())
+            positions = None
+        elif tier in DIFFICULTY_TIERS:
+            positions, ranks = self._tiers.get((length, tier), ((), ()))
+        else:
+            raise ValueError('Unknown difficulty {}'.format(tier))
+        count = len(ranks)
+        if max_rank is not None:
+            count = bisect.bisect_left(ranks, max_rank)
+        if not count:
+            raise ValueError('No words of length {} match'.format(length))
+        choice = random.randrange(count)
+        if positions is None:
+            return choice
+        return positions[choice]
+
+
+_index = None
+_features = None
+
+
+def load_index():
+    """Returns the process wide word index, loading it on first use. A
+    prebuilt index is used when it is present and matches dictionary.dat,
+    otherwise the index is built from the word list."""
+    global _index
+    if _index is None:
+        index = None
+        if os.path.exists(INDEX_PATH):
+            try:
+                index = WordIndex.from_file()
+                index.verify()
+            except (StaleIndexError, struct.error) as e:
+                logging.warning('Ignoring word index: %s', e)
+                index = None
+        if index is None:
+            index = WordIndex.from_wordlist()
+        _index = index
+    return _index
+
+
+def load_features():
+    """Returns the process wide WordFeatures table, read from the prebuilt
+    index when there is one and computed from the word list otherwise."""
+    global _features
+    if _features is None:
+        index = load_index()
+        if index.features is not None:
+            _features = WordFeatures(index, index.features)
+        else:
+            _features = WordFeatures.from_wordlist(index)
+    return _features
+
+
+def select_word(length, difficulty=None, max_rank=None):
+    """Returns a random word of the given length, optionally limited to a
+    difficulty tier and to the max_rank most common words. Raises ValueError
+    if no word matches."""
+    features = load_features()
+    position = features.random_position(length, difficulty, max_rank)
+    return features.index.word(length, position)
+
 
 def rand_english_word(length):
-    """takes the length of a desired word, and returns a dictionary word of
-    that length 0 indexed. Word is represented as a list of characters."""
-
-    potential_word = []
-    # run through a dictionary, return a random words of the defined length.
-    with open('dictionary.dat') as f:
-        wordlist = f.readlines()
-        for word in wordlist:
-            if len(word) == length + 1:
-                potential_word.append(word)
-    # count how many words meet the criteria, and use that in the range when
-    # generating a random int, then make sure the game settings match the data:
-    word_number = len(potential_word)
-    try:
-        word = potential_word[random.randint(1,word_number-1)]
-    except ValueError as e:
-        print 'Game Config Error: No words of specified length in word list'
-        sys.exit(1)
-
-    # verified word, convert to list of chars and del the newline:
-    word = potential_word[random.randint(1,word_number)]
-    # debug:
-    return word
+    """takes the length of a desired word, and returns a random dictionary word
+    of that length. Raises ValueError if no word of that length exists."""
+    return load_index().random_word(length)
+
+
+if __name__ == '__main__':
+    # Rebuild the prebuilt index: python gamefunc.py
+    index = WordIndex.from_wordlist()
+    index.write(WordFeatures.from_wordlist(index))
+    WordIndex.from_file().verify()
+    print 'Wrote {}'.format(INDEX_PATH)
@@ -0,0 +1,171 @@
+"""gamestate.py - Move evaluation shared by the API and the CLI game. A word is
+held as one position bitmask per letter, and the revealed positions and the
+guessed letters are bitsets, so each guess is decided with a couple of integer
+operations. The whole state packs into a short byte string for storage."""
+
+import struct
+
+HIT = 'hit'
+MISS = 'miss'
+WIN = 'win'
+
+_A = ord('a')
+_cache = {}
+
+# Packed layout: version, guessed bitset, revealed bitset, then the guess log.
+# Each log entry is one byte holding the letter index, with the high bit set
+# for a correct guess. Guesses that are not a single a-z letter are stored as
+# _OTHER (plus the high bit) followed by their length and utf-8 bytes.
+STATE_VERSION = 1
+_HEADER = struct.Struct('<BII')
+_CORRECT = 0x80
+_OTHER = 26
+
+
+def letter_index(letter):
+    """Returns 0-25 for a-z, or None for any other character"""
+    index = ord(letter) - _A
+    if 0 <= index < 26:
+        return index
+    return None
+
+
+def word_positions(word):
+    """Returns a list of 26 ints, bit i of entry n is set when letter n is at
+    position i of word."""
+    positions = _cache.get(word)
+    if positions is None:
+        positions = [0] * 26
+        for i, char in enumerate(word):
+            index = letter_index(char)
+            if index is not None:
+                positions[index] |= 1 << i
+        if len(_cache) > 1024:
+            _cache.clear()
+        _cache[word] = positions
+    return positions
+
+
+class GameState(object):
+    """The progress of a single game of hangman.
+    Attributes:
+        word: The target word.
+        revealed: Bitset of the word positions that have been guessed.
+        guessed: Bitset of the letters that have been guessed.
+        log: Packed record of every guess in order."""
+    __slots__ = ('word', 'positions', 'complete', 'revealed', 'guessed', 'log')
+
+    def __init__(self, word, revealed=0, guessed=0, log=''):
+        self.word = word
+        self.positions = word_positions(word)
+        self.complete = (1 << len(word)) - 1
+        self.revealed = revealed
+        self.guessed = guessed
+        self.log = log
+
+    @classmethod
+    def unpack(cls, word, packed):
+        """Rebuilds a state from the output of pack."""
+        version, guessed, revealed = _HEADER.unpack_from(packed)
+        if version != STATE_VERSION:
+            raise ValueError('Unknown game state version {}'.format(version))
+        return cls(word, revealed, guessed, packed[_HEADER.size:])
+
+    def pack(self):
+        """Returns the state as a byte string"""
+        return _HEADER.pack(STATE_VERSION, self.guessed, self.revealed) + \
+            self.log
+
+    @classmethod
+    def from_pattern(cls, word, pattern):
+        """Rebuilds a state from a list of revealed letters and '_', as
+        stored in Game.current_guesses. Games won by guessing the whole word
+        stored ['winner'] instead, which reveals every position."""
+        state = cls(word)
+        if list(pattern) == ['winner']:
+            pattern = word
+        for i, char in enumerate(pattern[:len(word)]):
+            # Skip anything else that is not a single revealed letter.
+            if char != '_' and len(char) == 1:
+                state.revealed |= 1 << i
+                index = letter_index(char)
+                if index is not None:
+                    state.guessed |= 1 << index
+        return state
+
+    @property
+    def won(self):
+        return self.revealed == self.complete
+
+    def guess(self, guess):
+        """Applies a guess of a single letter or the whole word and records
+        it in the log. Returns HIT, MISS or WIN."""
+        outcome = self._evaluate(guess)
+        self.record(guess, outcome != MISS)
+        return outcome
+
+    def record(self, guess, correct):
+        """Appends a guess to the log without evaluating it"""
+        flag = _CORRECT if correct else 0
+        index = letter_index(guess) if len(guess) == 1 else None
+        if index is not None:
+            self.log += chr(index | flag)
+        else:
+            encoded = guess.encode('utf-8')[:255]
+            self.log += chr(_OTHER | flag) + chr(len(encoded)) + encoded
+
+    def replay(self, guess, correct):
+        """Appends a guess from an older game's move history to the log,
+        marking a single letter as guessed. Positions are not revealed, the
+        older format stored those separately."""
+        index = letter_index(guess) if len(guess) == 1 else None
+        if index is not None:
+            self.guessed |= 1 << index
+        self.record(guess, correct)
+
+    def moves(self):
+        """Yields (guess, correct) for each logged guess in order"""
+        log = self.log
+        i = 0
+        while i < len(log):
+            entry = ord(log[i])
+            correct = bool(entry & _CORRECT)
+            index = entry & ~_CORRECT
+            if index == _OTHER:
+                length = ord(log[i + 1])
+                yield (log[i + 2:i + 2 + length].decode('utf-8', 'replace'),
+                       correct)
+                i += 2 + length
+            else:
+                yield chr(_A + index), correct
+                i += 1
+
+    def _evaluate(self, guess):
+        if len(guess) != 1:
+            if guess != self.word:
+                return MISS
+            for char in set(guess):
+                self.guessed |= 1 << letter_index(char)
+            self.revealed = self.complete
+            return WIN
+        index = letter_index(guess)
+        if index is None:
+            return MISS
+        self.guessed |= 1 << index
+        mask = self.positions[index]
+        if not mask:
+            return MISS
+        self.revealed |= mask
+        return WIN if self.revealed == self.complete else HIT
+
+    def masked(self):
+        """Returns the word as a list of characters with unrevealed letters
+        replaced by '_'"""
+        revealed = self.revealed
+        return [char if revealed >> i & 1 else '_'
+                for i, char in enumerate(self.word)]
+
+    def missed(self):
+        """Returns the guessed letters that are not in the word"""
+        return [chr(_A + i) for i in range(26)
+                if self.guessed >> i & 1 and not self.positions[i]]
@@ -3,6 +3,7 @@
 
 import gamefunc
 import sys
+from gamestate import GameState, MISS, letter_index
 
 # Game Settings:
 WORD_SIZE = 6
@@ -35,18 +36,13 @@ DEAD = '''
 '''
 
 class hangman():
-    def __init__(self):
-        '''Create a game'''
-        self.game_word = gamefunc.rand_english_word(WORD_SIZE)
-        self.max_tries = MAX_TRIES
+    def __init__(self, word_size=WORD_SIZE, max_tries=MAX_TRIES, word=None):
+        '''Create a game, with a random word of word_size unless a word is
+        given'''
+        self.game_word = word or gamefunc.rand_english_word(word_size)
+        self.max_tries = max_tries
         self.num_guesses = 0
-        self.completed_letters = self._guess_status()
-
-    def _guess_status(self, completed_letters=[]):
-        if completed_letters == []:
-            for i in range(WORD_SIZE):
-                completed_letters.append('_')
-        return completed_letters
+        self.state = GameState(self.game_word)
 
     def make_guess(self):
         '''Accept a character, sanitize.'''
@@ -62,28 +58,42 @@ class hangman():
         return letter
 
     def _verify_guess(self, guess):
-        # check to see if guess is in game word.
-        if guess in self.game_word:
-            location = self.game_word.index(guess)
-            self.completed_letters[location] = guess
-            return True
-        else:
-            return False
+        # check to see if guess is in game word, revealing every occurrence.
+        return self.state.guess(guess.lower()) != MISS
+
+    def simulate(self, strategy):
+        '''Plays the game without input, taking guesses from a strategy (see
+        simulate.py). Returns a tuple of whether the game was won, the number
+        of wrong guesses and the total number of guesses.'''
+        strategy.start(len(self.game_word))
+        wrong_guesses = 0
+        while wrong_guesses < self.max_tries and not self.state.won:
+            guess = strategy.next_guess()
+            self.num_guesses += 1
+            if self._verify_guess(guess):
+                index = letter_index(guess) if len(guess) == 1 else None
+                mask = self.state.positions[index] if index is not None \
+                    else self.state.complete
+            else:
+                wrong_guesses += 1
+                mask = 0
+            strategy.observe(guess, mask)
+        return self.state.won, wrong_guesses, self.num_guesses
 
     def play(self):
         game = hangman()
         print "Welcome to Paul's Hangman!\n"
         print "A word has been generated, its {} characters long.\
-                                                             ".format(WORD_SIZE)
+                                                   ".format(len(self.game_word))
         wrong_guesses = 0
         while wrong_guesses < self.max_tries:
             print "current status of word:"
-            print self.completed_letters
+            print self.state.masked()
             print 'Guess a letter!'
             guess = self.make_guess()
             if self._verify_guess(guess):
                 print 'Correct Guess!'
-                if '_' not in self.completed_letters:
+                if self.state.won:
                     print 'Game over! You Win!'
                     sys.exit(0)
             else:
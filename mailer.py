@@ -0,0 +1,192 @@
+"""mailer.py - Dispatcher for reminder emails. Each player to remind is put on
+the 'reminders' pull queue. Worker tasks on the 'reminder-workers' push queue
+lease the reminders in batches and send them at up to SEND_RATE a second each.
+A failed send is retried after an exponential backoff, and dropped after
+MAX_ATTEMPTS. The time of each user's last reminder is recorded, so a rerun
+within REMIND_INTERVAL does not mail anyone twice."""
+
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+
+import counters
+
+REMINDER_QUEUE = 'reminders'
+WORKER_QUEUE = 'reminder-workers'
+WORKER_URL = '/tasks/dispatch_reminders'
+# Reminders leased at once, and emails sent per second, by one worker.
+LEASE_BATCH = 50
+SEND_RATE = 5.0
+# Extra lease time on top of the time a batch takes to send.
+LEASE_MARGIN_SECONDS = 60
+# A worker stops leasing after this long, well inside the task deadline.
+WORKER_SECONDS = 480
+# Workers started within this many seconds of each other are deduplicated.
+WORKER_INTERVAL = 10
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 3600
+REMIND_INTERVAL = timedelta(hours=24)
+# At most this many tasks can be added to a queue in one call.
+MAX_TASKS_PER_ADD = 100
+
+SENT_COUNTER = 'reminders_sent'
+FAILED_COUNTER = 'reminders_failed'
+SKIPPED_COUNTER = 'reminders_skipped'
+DROPPED_COUNTER = 'reminders_dropped'
+MEMCACHE_LAST_RUN = 'REMINDERS_LAST_RUN'
+
+SUBJECT = 'You have incomplete Hangman games!!'
+BODY = 'Hello {}, stop what your doing and finish your game'
+
+
+class ReminderLog(ndb.Model):
+    """When a User was last sent a reminder. The key id is the User key's id,
+    kept apart from the User so that recording a reminder cannot overwrite
+    concurrent changes to it."""
+    last_sent = ndb.DateTimeProperty(required=True, indexed=False)
+
+
+def _log_key(user_key):
+    return ndb.Key(ReminderLog, user_key.id())
+
+
+def enqueue(user_keys):
+    """Puts a reminder for each user on the pull queue. Tasks are named after
+    the user and the current REMIND_INTERVAL, so a user queued twice in one
+    interval gets one reminder."""
+    period = int(time.time()) // int(REMIND_INTERVAL.total_seconds())
+    tasks = [taskqueue.Task(method='PULL', payload=key.urlsafe(),
+                            name='reminder-{}-{}'.format(key.urlsafe(), period))
+             for key in user_keys]
+    queue = taskqueue.Queue(REMINDER_QUEUE)
+    for start in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[start:start + MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # The rest of the batch is still added.
+            pass
+
+
+def start_worker(countdown=0):
+    """Queues a dispatch worker. Requests within one WORKER_INTERVAL share a
+    worker, and queue.yaml caps how many run at once."""
+    bucket = int(time.time() + countdown) // WORKER_INTERVAL
+    try:
+        taskqueue.add(url=WORKER_URL, queue_name=WORKER_QUEUE,
+                      name='reminder-worker-{}'.format(bucket),
+                      countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _backoff(task):
+    """Seconds to wait before a failed reminder is tried again"""
+    return min(BACKOFF_SECONDS * 2 ** task.retry_count, MAX_BACKOFF_SECONDS)
+
+
+def dispatch(rate=SEND_RATE, budget=WORKER_SECONDS):
+    """Leases and sends reminders until none are ready or the time budget is
+    spent. Returns a Counter of reminders sent, failed, skipped and
+    dropped."""
+    queue = taskqueue.Queue(REMINDER_QUEUE)
+    sender = 'noreply@{}.appspotmail.com'.format(
+                                        app_identity.get_application_id())
+    lease_seconds = int(LEASE_BATCH / rate) + LEASE_MARGIN_SECONDS
+    interval = 1.0 / rate
+    started = next_send = time.time()
+    totals = Counter()
+    while time.time() - started < budget:
+        tasks = queue.lease_tasks(lease_seconds, LEASE_BATCH)
+        if not tasks:
+            break
+        user_keys = [ndb.Key(urlsafe=task.payload) for task in tasks]
+        users = ndb.get_multi(user_keys)
+        logs = ndb.get_multi([_log_key(key) for key in user_keys])
+        now = datetime.now()
+        done = []
+        sent = []
+        for task, user, log in zip(tasks, users, logs):
+            if not user or not user.email or \
+                    (log and log.last_sent > now - REMIND_INTERVAL):
+                totals['skipped'] += 1
+                done.append(task)
+                continue
+            if task.retry_count >= MAX_ATTEMPTS:
+                logging.error('Dropping reminder to %s after %d attempts',
+                              user.email, task.retry_count)
+                totals['dropped'] += 1
+                done.append(task)
+                continue
+            # Hold to the send rate.
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_send = max(next_send, time.time() - interval) + interval
+            try:
+                mail.send_mail(sender, user.email, SUBJECT,
+                               BODY.format(user.name))
+            except (mail.Error, apiproxy_errors.Error) as e:
+                logging.warning('Reminder to %s failed: %s', user.email, e)
+                totals['failed'] += 1
+                # Hold the task until its backoff has passed.
+                queue.modify_task_lease(task, _backoff(task))
+                continue
+            totals['sent'] += 1
+            sent.append(ReminderLog(key=_log_key(user.key), last_sent=now))
+            done.append(task)
+        # Record the sends before releasing their tasks, so that a failure in
+        # between can only cause a resend, never a lost reminder.
+        ndb.put_multi(sent)
+        if done:
+            queue.delete_tasks(done)
+
+    seconds = time.time() - started
+    counters.increment({SENT_COUNTER: totals['sent'],
+                        FAILED_COUNTER: totals['failed'],
+                        SKIPPED_COUNTER: totals['skipped'],
+                        DROPPED_COUNTER: totals['dropped']})
+    memcache.set(MEMCACHE_LAST_RUN, {'finished': time.time(),
+                                     'seconds': seconds,
+                                     'totals': dict(totals)})
+    logging.info('Reminder worker: %s in %.1fs, %.2f sent/s',
+                 dict(totals), seconds, totals['sent'] / seconds if seconds
+                 else 0.0)
+    return totals
+
+
+def run_worker():
+    """Runs one dispatch worker, then queues another if reminders remain.
+    Reminders waiting out a backoff are picked up by a later worker."""
+    dispatch()
+    if taskqueue.Queue(REMINDER_QUEUE).fetch_statistics().tasks:
+        start_worker(countdown=BACKOFF_SECONDS)
+
+
+def stats():
+    """Returns the backlog of the reminder queue, the reminders sent,
+    failed, skipped and dropped so far, and the last worker run."""
+    queue_stats = taskqueue.Queue(REMINDER_QUEUE).fetch_statistics()
+    oldest = None
+    if queue_stats.oldest_eta_usec:
+        oldest = time.time() - queue_stats.oldest_eta_usec / 1e6
+    totals = counters.get_counts([SENT_COUNTER, FAILED_COUNTER,
+                                  SKIPPED_COUNTER, DROPPED_COUNTER])
+    return {'backlog': queue_stats.tasks,
+            'oldest_seconds': oldest,
+            'leased_last_minute': queue_stats.leased_last_minute,
+            'leased_last_hour': queue_stats.leased_last_hour,
+            'sent': totals[SENT_COUNTER],
+            'failed': totals[FAILED_COUNTER],
+            'skipped': totals[SKIPPED_COUNTER],
+            'dropped': totals[DROPPED_COUNTER],
+            'last_run': memcache.get(MEMCACHE_LAST_RUN)}
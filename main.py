@@ -3,50 +3,183 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import json
+
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import PaulsHangmanApi
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+import candidates
+import gamecache
+import gamefunc
+import mailer
+import metrics
+import queries
 from models import Game
 
 from models import User
 
+MIGRATE_BATCH_SIZE = 200
+RECOMPUTE_BATCH_SIZE = 50
+REMINDER_BATCH_SIZE = 100
+# Word lengths whose hint matrices are built by the warmup request.
+WARM_WORD_SIZES = range(3, 11)
+
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        # from the list off all users with email addresses, generate a list of
-        # all players with incomplete games:
-        contactable_users = []
-        for user in users:
-            game_search = Game.query(Game.user == user.key,
-                                     Game.game_over == False)
-            if len(game_search.fetch()) > 0:
-                contactable_users.append(user)
-
-        # Spam users with incomplete games.
-        for user in contactable_users:
-                subject = 'You have incomplete Hangman games!!'
-                body = ('Hello {}, stop what your doing and finish your game'
-                                                             ).format(user.name)
-
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                                                                   user.email,
-                                                                   subject,
-                                                                   body)
+        Called every hour using a cron job. The users are found in chunks by
+        SendReminderBatch tasks, which queue their reminders for the mailer
+        workers, so the cron request itself only queues the first chunk."""
+        taskqueue.add(url='/tasks/send_reminders')
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Queue reminders for one chunk of the players with incomplete
+        games, and start a worker to send them."""
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        # A projection of the user of every active game, ordered by user so
+        # that players with several games are only returned once.
+        games, cursor, more = queries.active_game_users().fetch_page(
+                REMINDER_BATCH_SIZE, start_cursor=cursor)
+        # Queue the next chunk first, so chunks run side by side.
+        if more and cursor:
+            taskqueue.add(url='/tasks/send_reminders',
+                          params={'cursor': cursor.urlsafe()})
+        # Spam users with incomplete games, see mailer.py.
+        mailer.enqueue([game.user for game in games])
+        mailer.start_worker()
+        self.response.set_status(204)
+
+
+class DispatchReminders(webapp2.RequestHandler):
+    def post(self):
+        """Send queued reminders at the configured rate until none are
+        ready, then queue another worker if any are left."""
+        mailer.run_worker()
+        self.response.set_status(204)
+
+
+class ReminderStats(webapp2.RequestHandler):
+    def get(self):
+        """Show the reminder backlog and how many have been sent."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(mailer.stats(), indent=2,
+                                       sort_keys=True))
+
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
     def post(self):
         """Update game listing announcement in memcache."""
+        # The API module is imported where it is used, keeping endpoints
+        # off the start up path of instances that only run tasks.
+        from api import PaulsHangmanApi
         PaulsHangmanApi._cache_average_attempts()
         self.response.set_status(204)
 
+class FlushGame(webapp2.RequestHandler):
+    def post(self):
+        """Write back the cached moves of a game that has gone idle."""
+        gamecache.flush(self.request.get('urlsafe_game_key'))
+        self.response.set_status(204)
+
+
+class ReconcileAverageMovesRemaining(webapp2.RequestHandler):
+    def get(self):
+        """Recount the active games behind the average moves remaining.
+        Called periodically using a cron job"""
+        from api import PaulsHangmanApi
+        PaulsHangmanApi._reconcile_average_attempts()
+
+
+class MigrateGameState(webapp2.RequestHandler):
+    def get(self):
+        """Start moving every Game over to the packed game state."""
+        taskqueue.add(url='/tasks/migrate_game_state')
+        self.response.write('Game state migration started')
+
+    def post(self):
+        """Migrate one batch of Games, then queue the next batch."""
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        games, cursor, more = Game.query().fetch_page(MIGRATE_BATCH_SIZE,
+                                                      start_cursor=cursor)
+        ndb.put_multi([game for game in games if game.migrate_state()])
+        if more and cursor:
+            taskqueue.add(url='/tasks/migrate_game_state',
+                          params={'cursor': cursor.urlsafe()})
+        self.response.set_status(204)
+
+class RecomputeRankings(webapp2.RequestHandler):
+    def get(self):
+        """Start rebuilding every User's score totals and ranking."""
+        taskqueue.add(url='/tasks/recompute_rankings')
+        self.response.write('Ranking recompute started')
+
+    def post(self):
+        """Recompute one batch of Users from their Scores, then queue the
+        next batch."""
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        users, cursor, more = User.query().fetch_page(RECOMPUTE_BATCH_SIZE,
+                                                      start_cursor=cursor)
+        for user in users:
+            user.recompute_scores()
+        ndb.put_multi(users)
+        if more and cursor:
+            taskqueue.add(url='/tasks/recompute_rankings',
+                          params={'cursor': cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class RefreshRanking(webapp2.RequestHandler):
+    def post(self):
+        """Copy a User's statistics counters into their entity and update
+        their ranking. Queued by end_game, at most once per RANKING_INTERVAL
+        for each user."""
+        User.refresh_ranking(ndb.Key(urlsafe=self.request.get(
+                                                        'urlsafe_user_key')))
+        self.response.set_status(204)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the API and the per instance word data before the instance
+        is sent traffic, so that no user request pays for it."""
+        import api
+        gamefunc.load_features()
+        candidates.warm(WARM_WORD_SIZES)
+        self.response.set_status(200)
+
+
+class ApiMetrics(webapp2.RequestHandler):
+    def get(self):
+        """Show the API call counts, latencies and RPCs per call, summed
+        over all instances. Add ?reset=1 to start counting afresh."""
+        if self.request.get('reset'):
+            metrics.reset()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(metrics.summary(), indent=2,
+                                       sort_keys=True))
+
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/dispatch_reminders', DispatchReminders),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/flush_game', FlushGame),
+    ('/crons/reconcile_average_attempts', ReconcileAverageMovesRemaining),
+    ('/tasks/migrate_game_state', MigrateGameState),
+    ('/tasks/recompute_rankings', RecomputeRankings),
+    ('/tasks/refresh_ranking', RefreshRanking),
+    ('/admin/metrics', ApiMetrics),
+    ('/admin/reminders', ReminderStats),
+    ('/_ah/warmup', Warmup),
 ], debug=True)
@@ -0,0 +1,205 @@
+"""metrics.py - Per request instrumentation of the API. Every call to an
+instrumented method counts its RPCs by service and method, and the time spent
+waiting on each service. Each call is logged as one structured line and added
+to per-instance totals, which are folded into memcache every FLUSH_SECONDS so
+the totals of all instances can be read in one place."""
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import Counter
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_METRICS = 'API_METRICS'
+FLUSH_SECONDS = 10
+CAS_RETRIES = 5
+
+_local = threading.local()
+_lock = threading.Lock()
+# Totals of this instance not yet folded into memcache, keyed by
+# (method name, metric).
+_totals = Counter()
+_last_flush = [time.time()]
+
+
+class CallRecord(object):
+    """The measurements of one API call"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        # 'service.method' -> calls made
+        self.rpcs = Counter()
+        # service -> milliseconds from making an RPC to its completion
+        self.rpc_ms = Counter()
+        # phase name -> milliseconds
+        self.phases = Counter()
+        self._pending = {}
+
+    def rpc_started(self, service, call, rpc):
+        self.rpcs['{}.{}'.format(service, call)] += 1
+        self._pending[id(rpc)] = time.time()
+
+    def rpc_finished(self, service, rpc):
+        started = self._pending.pop(id(rpc), None)
+        if started is not None:
+            self.rpc_ms[service] += (time.time() - started) * 1000
+
+
+def _current():
+    return getattr(_local, 'record', None)
+
+
+def _pre_call(service, call, request, response, rpc):
+    record = _current()
+    if record is not None:
+        record.rpc_started(service, call, rpc)
+
+
+def _post_call(service, call, request, response, rpc):
+    record = _current()
+    if record is not None:
+        record.rpc_finished(service, rpc)
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('api_metrics', _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('api_metrics', _post_call)
+
+
+class phase(object):
+    """Context manager timing a named part of the current API call:
+        with metrics.phase('load'):
+            ..."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        record = _current()
+        if record is not None:
+            record.phases[self.name] += (time.time() - self.start) * 1000
+
+
+def instrumented(name, method):
+    """Returns method wrapped to record each call under name"""
+    @functools.wraps(method)
+    def wrapper(service, request):
+        record = _local.record = CallRecord(name)
+        status = 'ok'
+        try:
+            return method(service, request)
+        except Exception as e:
+            status = e.__class__.__name__
+            raise
+        finally:
+            _local.record = None
+            _finish(record, status)
+    return wrapper
+
+
+def instrument(service_class):
+    """Class decorator instrumenting every remote method of a protorpc
+    Service. Apply it below @endpoints.api, so endpoints sees the wrapped
+    methods."""
+    for name, method in service_class.all_remote_methods().iteritems():
+        setattr(service_class, name,
+                instrumented(name, service_class.__dict__[name]))
+    return service_class
+
+
+def _finish(record, status):
+    elapsed = (time.time() - record.start) * 1000
+    logging.info('api_call %s', json.dumps({
+        'method': record.name,
+        'status': status,
+        'ms': round(elapsed, 1),
+        'rpcs': record.rpcs,
+        'rpc_ms': dict((service, round(ms, 1))
+                       for service, ms in record.rpc_ms.iteritems()),
+        'phases': dict((name, round(ms, 1))
+                       for name, ms in record.phases.iteritems()),
+    }, sort_keys=True))
+
+    deltas = Counter({(record.name, 'calls'): 1,
+                      (record.name, 'ms'): int(elapsed)})
+    if status != 'ok':
+        deltas[(record.name, 'errors')] += 1
+    for call, count in record.rpcs.iteritems():
+        deltas[(record.name, 'rpc:' + call)] += count
+    for service, ms in record.rpc_ms.iteritems():
+        deltas[(record.name, 'rpc_ms:' + service)] += int(ms)
+    for name, ms in record.phases.iteritems():
+        deltas[(record.name, 'phase_ms:' + name)] += int(ms)
+    with _lock:
+        _totals.update(deltas)
+    if time.time() - _last_flush[0] >= FLUSH_SECONDS:
+        flush()
+
+
+def flush():
+    """Folds this instance's totals into the shared totals in memcache"""
+    with _lock:
+        if not _totals:
+            return
+        pending = dict(_totals)
+        _totals.clear()
+        _last_flush[0] = time.time()
+    client = memcache.Client()
+    for attempt in range(CAS_RETRIES):
+        shared = client.gets(MEMCACHE_METRICS)
+        if shared is None:
+            if client.add(MEMCACHE_METRICS, {'since': time.time(),
+                                             'totals': pending}):
+                return
+            continue
+        totals = Counter(shared['totals'])
+        totals.update(pending)
+        shared['totals'] = dict(totals)
+        if client.cas(MEMCACHE_METRICS, shared):
+            return
+    # Give up on this round, the totals are kept for the next flush.
+    with _lock:
+        _totals.update(pending)
+
+
+def summary():
+    """Returns the shared totals as a dict of method name -> calls, errors,
+    mean milliseconds, and per call averages of RPCs, RPC wait by service
+    and phase times."""
+    flush()
+    shared = memcache.get(MEMCACHE_METRICS)
+    if shared is None:
+        return {'since': None, 'methods': {}}
+    methods = {}
+    for (name, metric), value in shared['totals'].iteritems():
+        methods.setdefault(name, {})[metric] = value
+    result = {}
+    for name, metrics in methods.iteritems():
+        calls = metrics.get('calls') or 1
+        method = {'calls': metrics.get('calls', 0),
+                  'errors': metrics.get('errors', 0),
+                  'mean_ms': float(metrics.get('ms', 0)) / calls,
+                  'rpcs_per_call': {}, 'rpc_ms_per_call': {},
+                  'phase_ms_per_call': {}}
+        for metric, value in metrics.iteritems():
+            for prefix, field in (('rpc:', 'rpcs_per_call'),
+                                  ('rpc_ms:', 'rpc_ms_per_call'),
+                                  ('phase_ms:', 'phase_ms_per_call')):
+                if metric.startswith(prefix):
+                    method[field][metric[len(prefix):]] = float(value) / calls
+        result[name] = method
+    return {'since': shared['since'], 'methods': result}
+
+
+def reset():
+    """Discards the shared totals and this instance's unflushed totals"""
+    with _lock:
+        _totals.clear()
+    memcache.delete(MEMCACHE_METRICS)
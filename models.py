@@ -2,11 +2,42 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
+import bisect
 import random
-from datetime import date
+import re
+from datetime import date, timedelta
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+import counters
+import queries
+from gamestate import GameState
+
+# Format of the move_history entries written before the packed game state.
+LEGACY_MOVE = re.compile(r'\(Player Guess: (.*) Correct Guess: (True|False)\)')
+GAME_OVER_MOVE = 'Failed to guess word, Game Over!'
+
+LEADERBOARD_SIZE = 100
+LEADERBOARD_WINDOWS = ('all', 'day', 'week')
+MEMCACHE_LEADERBOARD = 'LEADERBOARD:{}'
+# Cached boards expire after LEADERBOARD_CACHE_SECONDS. After a change, the
+# cached board cannot be re-added for LEADERBOARD_LOCK_SECONDS, so a reader
+# that loaded the board before the change cannot cache its older copy.
+LEADERBOARD_CACHE_SECONDS = 600
+LEADERBOARD_LOCK_SECONDS = 5
+
+# Sharded counters over the active (not game_over) games.
+ACTIVE_GAMES_COUNTER = 'active_games'
+ACTIVE_TRIES_COUNTER = 'active_tries_remaining'
+
+# Per user statistics, kept in sharded counters so that a player finishing
+# many games at once does not contend on the User entity.
+USER_STATS = ('completed_games', 'total_points', 'wins')
+DEFAULT_STAT_SHARDS = 2
+# Seconds between copies of a user's statistics into their User entity.
+RANKING_INTERVAL = 10
+
 ################################################################################
     ### Tracking user details.  ###
 ################################################################################
@@ -15,8 +46,94 @@ class User(ndb.Model):
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
     ranking_score = ndb.FloatProperty(required=True, default=10)
+    # Copies of the user's statistics counters, used to rank without a query.
+    # Refreshed at most every RANKING_INTERVAL seconds, see refresh_ranking.
     completed_games = ndb.IntegerProperty(required=True, default=0)
+    total_points = ndb.IntegerProperty(required=True, default=0)
+    wins = ndb.IntegerProperty(required=True, default=0)
+    # Shards of the statistics counters. Raise it for players who finish
+    # many games at once. Never lower it, the counts held in the dropped
+    # shards would be lost.
+    stat_shards = ndb.IntegerProperty(required=True,
+                                      default=DEFAULT_STAT_SHARDS,
+                                      indexed=False)
+    # False for users created before the statistics counters, until
+    # refresh_ranking rebuilds their totals from their Scores.
+    stats_sharded = ndb.BooleanProperty(required=True, default=False,
+                                        indexed=False)
+
+    def stat_counter(self, stat):
+        """Returns the name of the counter holding one of USER_STATS"""
+        return 'user:{}:{}'.format(self.key.id(), stat)
 
+    def score_deltas(self, score):
+        """Returns the counter deltas that record a completed game's Score"""
+        return {self.stat_counter('completed_games'): 1,
+                self.stat_counter('total_points'): score.points,
+                self.stat_counter('wins'): 1 if score.won else 0}
+
+    def get_stats(self, cached=True):
+        """Returns a dict of stat -> total, summed from the statistics
+        counters. cached=False reads the counter shards rather than the
+        cached totals."""
+        totals = counters.get_counts([self.stat_counter(stat)
+                                      for stat in USER_STATS],
+                                     self.stat_shards, cached)
+        return dict((stat, totals[self.stat_counter(stat)])
+                    for stat in USER_STATS)
+
+    @classmethod
+    def refresh_ranking(cls, user_key):
+        """Copies a user's statistics counters into completed_games,
+        total_points and wins, and updates the ranking from them."""
+        user = user_key.get()
+        if user is None:
+            return
+        if not user.stats_sharded:
+            # Users from before the statistics counters may only have a
+            # correct completed_games and ranking_score, so their totals are
+            # rebuilt from their Scores rather than taken from the entity.
+            user.recompute_scores()
+            user.put()
+            return
+        # The totals are stored on the User, so they are read from the
+        # shards rather than from a cached total that may have drifted.
+        cls._store_stats(user_key, user.get_stats(cached=False))
+
+    @staticmethod
+    @ndb.transactional
+    def _store_stats(user_key, stats):
+        user = user_key.get()
+        for stat in USER_STATS:
+            setattr(user, stat, stats[stat])
+        user.update_ranking()
+        user.put()
+
+    def recompute_scores(self):
+        """Rebuilds the statistics counters, their copies and the ranking
+        from every Score of the user. Used to repair the totals, end_game
+        keeps them current. The caller puts the User."""
+        self.completed_games = 0
+        self.total_points = 0
+        self.wins = 0
+        for score in queries.user_score_totals(self.key):
+            self.completed_games += 1
+            self.total_points += score.points
+            if score.won:
+                self.wins += 1
+        counters.reset(dict((self.stat_counter(stat), getattr(self, stat))
+                            for stat in USER_STATS), self.stat_shards)
+        self.stats_sharded = True
+        self.update_ranking()
+
+    def update_ranking(self):
+        """Sets ranking_score from the running totals. The ranking is the
+        average score over all completed games, where a won game is worth 10
+        extra points."""
+        if not self.completed_games:
+            return
+        total_score = self.total_points + self.wins * 10
+        self.ranking_score = float(total_score) / self.completed_games + 100
 
     @classmethod
     def to_form(self):
@@ -30,6 +147,25 @@ class User(ndb.Model):
         return UserRank(user_name=self.name,
                         ranking_score=self.ranking_score)
 
+    @classmethod
+    @ndb.transactional(xg=True)
+    def create(cls, name, email):
+        """Creates a User and claims its name in the UserName index. Returns
+        None if the name is already taken."""
+        index_key = ndb.Key(UserName, name)
+        if index_key.get():
+            return None
+        user = cls(name=name, email=email, stats_sharded=True)
+        user.put()
+        UserName(key=index_key, user=user.key).put()
+        return user
+
+
+class UserName(ndb.Model):
+    """Index of User keys by name. The key id is the user name, which keeps
+    names unique and lets a user be found by key instead of by query."""
+    user = ndb.KeyProperty(required=True, kind='User')
+
 
 ################################################################################
     ### Tracking Games ###
@@ -42,26 +178,97 @@ class Game(ndb.Model):
     game_over = ndb.BooleanProperty(required=True, default=False)
     game_deleted = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
+    # Packed GameState: guessed letters, revealed positions and the guess log.
+    state = ndb.BlobProperty()
+    # Superseded by state. Kept so that older entities can be read and
+    # migrated, see migrate_state.
     current_guesses = ndb.StringProperty(repeated=True)
     move_history = ndb.StringProperty(repeated=True)
 
     @classmethod
     def new_game(cls, user, game_word, attempts):
         """Creates and returns a new game"""
-        game = Game(user=user,
-                    game_word=game_word,
-                    max_tries=attempts,
-                    tries_remaining=attempts,
-                    game_over=False,
-                    move_history=[])
-        game.put()
-        return game
-
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+        return cls.new_games([(user, game_word)], attempts)[0]
+
+    @classmethod
+    def new_games(cls, players, attempts):
+        """Creates and returns several new games with one batch write.
+        Args:
+            players: A list of (User key, game word) pairs, one per game
+            attempts: The tries allowed in each game"""
+        games = [Game(user=user,
+                      game_word=game_word,
+                      max_tries=attempts,
+                      tries_remaining=attempts,
+                      game_over=False,
+                      state=GameState(game_word).pack())
+                 for user, game_word in players]
+        ndb.put_multi(games)
+        Game.count_active(games=len(games), tries=attempts * len(games))
+        return games
+
+    @staticmethod
+    def count_active(games=0, tries=0):
+        """Adjusts the counters of active games and their tries remaining"""
+        counters.increment({ACTIVE_GAMES_COUNTER: games,
+                            ACTIVE_TRIES_COUNTER: tries})
+
+    def get_state(self):
+        """Returns the GameState of this game, decoding it on first use"""
+        state = getattr(self, '_game_state', None)
+        if state is None:
+            # Games created before the word index stored their word with a
+            # trailing newline.
+            word = self.game_word.rstrip('\n')
+            if self.state is not None:
+                state = GameState.unpack(word, self.state)
+            else:
+                state = GameState.from_pattern(word, self.current_guesses)
+                for move in self.move_history:
+                    match = LEGACY_MOVE.match(move)
+                    if match:
+                        state.replay(match.group(1),
+                                     match.group(2) == 'True')
+            self._game_state = state
+        return state
+
+    def set_state(self, state):
+        """Stores state in the packed state property"""
+        self._game_state = state
+        self.state = state.pack()
+        self.current_guesses = []
+        self.move_history = []
+
+    def move_count(self):
+        """Returns the number of guesses made in this game"""
+        return sum(1 for move in self.get_state().moves())
+
+    @ndb.transactional
+    def write_back(self):
+        """Puts this copy of the game, unless the stored game has already
+        finished or holds more moves, as when this copy is stale. Returns
+        True if it was written."""
+        stored = self.key.get()
+        if stored is not None and (stored.game_over or
+                                   stored.move_count() > self.move_count()):
+            return False
+        self.put()
+        return True
+
+    def migrate_state(self):
+        """Moves a game stored with current_guesses and move_history over to
+        the packed state. Returns True if the game needs to be put."""
+        if self.state is not None:
+            return False
+        self.set_state(self.get_state())
+        return True
+
+    def to_form(self, message, user_name=None):
+        """Returns a GameForm representation of the Game. user_name saves a
+        fetch of the User when the caller already knows it."""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user.get().name
         form.tries_remaining = self.tries_remaining
         form.game_over = self.game_over
         form.message = message
@@ -70,54 +277,65 @@ class Game(ndb.Model):
 
     def to_history_form(self):
         """ returns all moves in a game """
+        moves = ['(Player Guess: {0} Correct Guess: {1})'.format(guess, correct)
+                 for guess, correct in self.get_state().moves()]
+        if self.game_over and not self.game_deleted and \
+                self.tries_remaining < 1:
+            moves.append(GAME_OVER_MOVE)
         form = GameHistory()
-        form.move_history = str(self.move_history)
+        form.move_history = str(moves)
         return form
 
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. The game, its Score and the player's statistics are
+        written together in a single transaction, and the player's ranking
+        is refreshed from the statistics shortly after. Returns False, having
+        written nothing, if the stored game had already ended."""
+        # utils imports this module, so it can only be imported once in use.
+        from utils import schedule_debounced
         self.game_over = True
-        self.put()
 
         # Add the game to the score 'board'
         # Count the length of the target word, multiply it by the number of
         # guesses that remain (demonstrated skill). Reduce points for a large
         # number of max tries (reflect difficulty setting a game was played at.)
         difficulty = self.max_tries * 0.3
-        points = int(float((len(self.game_word) * self.tries_remaining))
+        points = int(float((len(self.game_word.rstrip('\n')) *
+                            self.tries_remaining))
                                                                / difficulty)
         score = Score(user=self.user,
                       date=date.today(),
                       won=won,
                       wrong_guesses=self.max_tries - self.tries_remaining,
                       points=points)
-        score.put()
-        self._update_ranking()
-        return
-
-    def _update_ranking(self):
-        """ Updates the ranking value associated the user"""
-        # DB calls, this operation relies on two seperate kinds.
-        player = User.query(User.key == self.user).get()
-        scores = Score.query(Score.user == self.user)
-
-        # Take this game into account when ranking:
-        player.completed_games = player.completed_games + 1
-        # Collect All Scores. calculate average score:
-        total_score = 0
-        for score in scores:
-            total_score = total_score + score.points
-            if score.won == True:
-                total_score += 10
-
-        total_score = float(total_score) / player.completed_games
-
-        # Write average score to User datastore.
-        #write updated rank to user Datastore, sort ranks on retrieval.
-        player.ranking_score = total_score + 100
-        player.put()
-        return
+        player = self.user.get()
+        deltas = player.score_deltas(score)
+        if not self._commit_end_game(score, deltas, player.stat_shards):
+            return False
+        counters.update_cached(deltas)
+        schedule_debounced('/tasks/refresh_ranking',
+                           'refresh-ranking-' + self.user.urlsafe(),
+                           RANKING_INTERVAL,
+                           {'urlsafe_user_key': self.user.urlsafe()})
+        Game.count_active(games=-1, tries=-self.tries_remaining)
+        if won:
+            Leaderboard.offer(score, player.name)
+        return True
+
+    @ndb.transactional(xg=True)
+    def _commit_end_game(self, score, deltas, shards):
+        """Writes the finished game and its score, and adds the score to a
+        random shard of each of the player's statistics counters. The User
+        entity is not written, so concurrent finishes by the same user do not
+        contend on it. Returns False if the stored game had already ended,
+        by another move or by del_game."""
+        stored = self.key.get()
+        if stored is not None and stored.game_over:
+            return False
+        ndb.put_multi([self, score])
+        counters.increment_shards(deltas, shards)
+        return True
 
 ################################################################################
     ### Define ranking and scoring ###
@@ -131,13 +349,145 @@ class Score(ndb.Model):
     wrong_guesses = ndb.IntegerProperty(required=True)
     points = ndb.IntegerProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name,
+    def to_form(self, user_name=None):
+        """Returns a ScoreForm representation of the Score. user_name saves a
+        fetch of the User when the caller already knows it."""
+        return ScoreForm(user_name=user_name or self.user.get().name,
                          won=self.won,
                          date=str(self.date),
                          guesses=self.wrong_guesses,
                          points=self.points)
 
+
+class LeaderboardEntry(ndb.Model):
+    """A won Score as held on a Leaderboard"""
+    score = ndb.KeyProperty(kind='Score')
+    user = ndb.KeyProperty(kind='User')
+    user_name = ndb.StringProperty()
+    date = ndb.DateProperty()
+    wrong_guesses = ndb.IntegerProperty()
+    points = ndb.IntegerProperty()
+
+    @classmethod
+    def from_score(cls, score, user_name):
+        return cls(score=score.key,
+                   user=score.user,
+                   user_name=user_name,
+                   date=score.date,
+                   wrong_guesses=score.wrong_guesses,
+                   points=score.points)
+
+    def to_form(self):
+        return ScoreForm(user_name=self.user_name,
+                         won=True,
+                         date=str(self.date),
+                         guesses=self.wrong_guesses,
+                         points=self.points)
+
+
+class Leaderboard(ndb.Model):
+    """The top LEADERBOARD_SIZE won Scores of one window of time, highest
+    points first. The key id names the window: 'all', 'day:2016-05-31' or
+    'week:2016-22' (ISO week). end_game offers each won Score to the boards
+    it falls in, and every board is mirrored in memcache so reads do not
+    touch the Score index."""
+    entries = ndb.LocalStructuredProperty(LeaderboardEntry, repeated=True)
+
+    @staticmethod
+    def window_id(window, day):
+        """Returns the key id of the board for window ('all', 'day' or
+        'week') that contains day."""
+        if window == 'all':
+            return 'all'
+        if window == 'day':
+            return 'day:{}'.format(day.isoformat())
+        if window == 'week':
+            year, week, weekday = day.isocalendar()
+            return 'week:{}-{:02d}'.format(year, week)
+        raise ValueError('Unknown leaderboard window {}'.format(window))
+
+    @classmethod
+    def get_entries(cls, window_id):
+        """Returns the entries of a board, from memcache where possible. A
+        board that has never been stored is built from the Scores."""
+        cache_id = MEMCACHE_LEADERBOARD.format(window_id)
+        entries = memcache.get(cache_id)
+        if entries is None:
+            board = cls.get_by_id(window_id)
+            if board is None:
+                board = cls._create(window_id, cls._build(window_id))
+            entries = board.entries
+            memcache.add(cache_id, entries, time=LEADERBOARD_CACHE_SECONDS)
+        return entries
+
+    @classmethod
+    @ndb.transactional
+    def _create(cls, window_id, entries):
+        """Stores a newly built board, unless another request stored the
+        board first. Returns the stored board."""
+        board = cls.get_by_id(window_id)
+        if board is None:
+            board = cls(id=window_id, entries=entries)
+            board.put()
+        return board
+
+    @classmethod
+    def offer(cls, score, user_name):
+        """Adds a won Score to each board it falls in, when it ranks within
+        the top LEADERBOARD_SIZE of that board."""
+        entry = LeaderboardEntry.from_score(score, user_name)
+        for window in LEADERBOARD_WINDOWS:
+            window_id = cls.window_id(window, score.date)
+            entries = cls.get_entries(window_id)
+            if len(entries) < LEADERBOARD_SIZE or \
+                    entry.points > entries[-1].points:
+                cls._insert(window_id, entry)
+                # Dropped rather than set, and locked against re-adds for a
+                # moment, so that neither concurrent offers nor readers can
+                # leave an older copy in memcache.
+                memcache.delete(MEMCACHE_LEADERBOARD.format(window_id),
+                                seconds=LEADERBOARD_LOCK_SECONDS)
+
+    @classmethod
+    @ndb.transactional
+    def _insert(cls, window_id, entry):
+        """Inserts entry after any entries with equal or more points and
+        trims the board. An entry for a Score already on the board, as when
+        the board was just built from the Scores, is not added again."""
+        board = cls.get_by_id(window_id) or cls(id=window_id)
+        if any(existing.score == entry.score for existing in board.entries):
+            return
+        ranks = [-existing.points for existing in board.entries]
+        board.entries.insert(bisect.bisect_right(ranks, -entry.points), entry)
+        del board.entries[LEADERBOARD_SIZE:]
+        board.put()
+
+    @staticmethod
+    def _build(window_id):
+        """Returns the entries for a board, read from the Scores."""
+        if window_id == 'all':
+            days = [None]
+        elif window_id.startswith('day:'):
+            year, month, day = window_id[4:].split('-')
+            days = [date(int(year), int(month), int(day))]
+        else:
+            year, week = window_id[5:].split('-')
+            # The 4th of January is always in ISO week 1.
+            first = date(int(year), 1, 4)
+            monday = first + timedelta(weeks=int(week) - 1,
+                                       days=1 - first.isoweekday())
+            days = [monday + timedelta(days=i) for i in range(7)]
+
+        scores = []
+        for day in days:
+            scores.extend(queries.won_scores(day).fetch(LEADERBOARD_SIZE))
+        scores.sort(key=lambda score: -score.points)
+        scores = scores[:LEADERBOARD_SIZE]
+        names = dict((user.key, user.name) for user in ndb.get_multi(
+                list(set(score.user for score in scores))) if user)
+        return [LeaderboardEntry.from_score(score, names.get(score.user))
+                for score in scores]
+
 ################################################################################
     ### Define IO Messages###
 ################################################################################
@@ -155,11 +505,40 @@ class NewGameForm(messages.Message):
     user_name = messages.StringField(1, required=True)
     word_size = messages.IntegerField(2, default=5)
     attempts = messages.IntegerField(4, default=5)
+    difficulty = messages.StringField(5)
+    max_rank = messages.IntegerField(6)
+
+class NewGamesForm(messages.Message):
+    """Used to create games_per_user new games for each of several users"""
+    user_names = messages.StringField(1, repeated=True)
+    games_per_user = messages.IntegerField(2, default=1)
+    word_size = messages.IntegerField(3, default=5)
+    attempts = messages.IntegerField(4, default=5)
+    difficulty = messages.StringField(5)
+    max_rank = messages.IntegerField(6)
 
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.StringField(1, required=True)
 
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game, in order"""
+    guesses = messages.StringField(1, repeated=True)
+
+class MoveResult(messages.Message):
+    """The outcome of one guess of a MakeMovesForm"""
+    guess = messages.StringField(1, required=True)
+    outcome = messages.StringField(2, required=True)
+    message = messages.StringField(3, required=True)
+
+class HintForm(messages.Message):
+    """The dictionary words still possible in a game, and the letter that
+    best splits them"""
+    pattern = messages.StringField(1, required=True)
+    remaining = messages.IntegerField(2, required=True)
+    letter = messages.StringField(3)
+    information = messages.FloatField(4, required=True)
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -183,14 +562,22 @@ class GameHistory(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class UserGames(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class UserRankings(messages.Message):
     """Return multiple UserRanks"""
     items = messages.MessageField(UserRank, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+class MoveResults(messages.Message):
+    """Return the outcome of each applied guess and the final game state"""
+    items = messages.MessageField(MoveResult, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
@@ -0,0 +1,130 @@
+"""queries.py - The datastore queries made on the request paths and by the
+task handlers. Each query is declared with the composite index it needs, and
+uses a projection wherever the caller does not need whole entities. Running
+`python queries.py` checks that index.yaml holds exactly the declared
+indexes."""
+
+import os
+import sys
+from collections import namedtuple
+
+import models
+
+# A composite index. properties lists property names in index order, with a
+# leading '-' for a descending property.
+Index = namedtuple('Index', 'kind properties')
+
+USER_GAMES_INDEX = Index('Game', ('user', 'game_over', 'game_deleted'))
+ACTIVE_GAME_TRIES_INDEX = Index('Game', ('game_over', 'tries_remaining'))
+ACTIVE_GAME_USERS_INDEX = Index('Game', ('game_over', 'user'))
+WON_SCORES_INDEX = Index('Score', ('won', '-points'))
+WON_SCORES_BY_DAY_INDEX = Index('Score', ('won', 'date', '-points'))
+USER_SCORE_TOTALS_INDEX = Index('Score', ('user', 'won', 'points'))
+RANKINGS_INDEX = Index('User', ('-ranking_score', 'name'))
+
+
+def user_games(user_key):
+    """The active games of a user"""
+    Game = models.Game
+    return Game.query(Game.user == user_key,
+                      Game.game_over == False,
+                      Game.game_deleted == False)
+
+
+def active_game_tries():
+    """The tries remaining of every active game"""
+    Game = models.Game
+    return Game.query(Game.game_over == False,
+                      projection=[Game.tries_remaining])
+
+
+def active_game_users():
+    """The distinct users with an active game, ordered by user"""
+    Game = models.Game
+    return Game.query(Game.game_over == False,
+                      projection=[Game.user],
+                      distinct=True).order(Game.user)
+
+
+def won_scores(day=None):
+    """Won scores, most points first, optionally only those of one day"""
+    Score = models.Score
+    query = Score.query(Score.won == True)
+    if day is not None:
+        query = query.filter(Score.date == day)
+    return query.order(-Score.points)
+
+
+def user_scores(user_key):
+    """The scores of a user. Served by the built-in index on user."""
+    Score = models.Score
+    return Score.query(Score.user == user_key)
+
+
+def user_score_totals(user_key):
+    """The won flag and points of each score of a user"""
+    Score = models.Score
+    return Score.query(Score.user == user_key,
+                       projection=[Score.won, Score.points])
+
+
+def rankings():
+    """The name and ranking of every user, highest ranking first"""
+    User = models.User
+    return User.query(projection=[User.ranking_score,
+                                  User.name]).order(-User.ranking_score)
+
+
+def user_by_name(name):
+    """Users with a name, fetched keys only. Served by the built-in index on
+    name, only needed for users created before the UserName index."""
+    User = models.User
+    return User.query(User.name == name)
+
+
+# Every declared query and the composite index it needs, None when it is
+# served by the built-in single property indexes.
+HOT_QUERIES = (
+    (user_games, USER_GAMES_INDEX),
+    (active_game_tries, ACTIVE_GAME_TRIES_INDEX),
+    (active_game_users, ACTIVE_GAME_USERS_INDEX),
+    (won_scores, WON_SCORES_INDEX),
+    (won_scores, WON_SCORES_BY_DAY_INDEX),
+    (user_scores, None),
+    (user_score_totals, USER_SCORE_TOTALS_INDEX),
+    (rankings, RANKINGS_INDEX),
+    (user_by_name, None),
+)
+
+
+def read_index_yaml(path):
+    """Returns the set of Indexes listed in an index.yaml file"""
+    import yaml
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    indexes = set()
+    for entry in config.get('indexes') or []:
+        properties = tuple(
+                ('-' if prop.get('direction') == 'desc' else '') + prop['name']
+                for prop in entry.get('properties', []))
+        indexes.add(Index(entry['kind'], properties))
+    return indexes
+
+
+def check_index_yaml(path):
+    """Compares the declared indexes with index.yaml. Returns a tuple of the
+    declared indexes missing from the file, and the indexes in the file that
+    no declared query uses."""
+    declared = set(index for query, index in HOT_QUERIES if index)
+    listed = read_index_yaml(path)
+    return declared - listed, listed - declared
+
+
+if __name__ == '__main__':
+    missing, unused = check_index_yaml(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'index.yaml'))
+    for index in sorted(missing):
+        print 'Missing from index.yaml: {}'.format(index)
+    for index in sorted(unused):
+        print 'Not used by any query: {}'.format(index)
+    sys.exit(1 if missing or unused else 0)
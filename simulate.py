@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""simulate.py - Headless simulation of hangman.py games, for tuning scoring
+and difficulty settings. Games are played by guessing strategies over the
+words in dictionary.dat, in batches spread over a process pool, and the
+results are reported per strategy, word length and max_tries.
+
+    python simulate.py --lengths 4 6 8 --max-tries 5 8 --games 20000
+
+Strategies get told the length of the word, then alternate between
+next_guess() and observe(guess, mask), where mask has bit i set for each
+position of the word that the guess revealed (0 for a miss)."""
+
+import argparse
+import multiprocessing
+import random
+import string
+import time
+from collections import Counter
+
+import gamefunc
+from gamestate import letter_index, word_positions
+from hangman import hangman
+
+_words = {}
+_positions = {}
+
+
+def words_of_length(length):
+    """Returns the dictionary words of a length, read once per process"""
+    words = _words.get(length)
+    if words is None:
+        index = gamefunc.load_index()
+        words = _words[length] = [index.word(length, i)
+                                  for i in range(index.count(length))]
+    return words
+
+
+def positions_of_length(length):
+    """Returns (word, word_positions(word)) for the words of a length"""
+    positions = _positions.get(length)
+    if positions is None:
+        positions = _positions[length] = [(word, word_positions(word))
+                                          for word in words_of_length(length)]
+    return positions
+
+
+def _letter_order(words):
+    """Returns a-z ordered by the number of words containing each letter"""
+    counts = Counter()
+    for word in words:
+        counts.update(set(word))
+    return sorted(string.ascii_lowercase, key=lambda letter: -counts[letter])
+
+
+class FrequencyStrategy(object):
+    """Guesses letters in a fixed order, most common in words of the length
+    first."""
+    name = 'frequency'
+    _orders = {}
+
+    def start(self, length):
+        order = self._orders.get(length)
+        if order is None:
+            order = self._orders[length] = _letter_order(
+                                                    words_of_length(length))
+        self._letters = iter(order)
+
+    def next_guess(self):
+        return next(self._letters)
+
+    def observe(self, guess, mask):
+        pass
+
+
+class CandidateStrategy(object):
+    """Keeps the dictionary words still consistent with every guess, and
+    guesses the letter found in the most of them. Guesses the word itself
+    once only one candidate is left.
+
+    The strategy is deterministic, so games retrace the same few states. The
+    candidates and the choice made for each state are memoised per process,
+    keyed by the word length and the (guess, mask) history."""
+    name = 'candidates'
+    _candidates = {}
+    _choices = {}
+
+    def start(self, length):
+        self._state = (length,)
+        if self._state not in self._candidates:
+            # (word, word_positions(word)) pairs
+            self._candidates[self._state] = positions_of_length(length)
+
+    def next_guess(self):
+        choice = self._choices.get(self._state)
+        if choice is None:
+            choice = self._choices[self._state] = self._choose()
+        return choice
+
+    def _choose(self):
+        candidates = self._candidates[self._state]
+        if len(candidates) == 1:
+            return candidates[0][0]
+        guessed = set(guess for guess, mask in self._state[1:])
+        counts = Counter()
+        for word, positions in candidates:
+            counts.update(set(word))
+        for letter in guessed:
+            counts.pop(letter, None)
+        if not counts:
+            # Nothing left to tell the candidates apart, or no candidates.
+            return next(letter for letter in string.ascii_lowercase
+                        if letter not in guessed)
+        return max(sorted(counts), key=counts.get)
+
+    def observe(self, guess, mask):
+        candidates = self._candidates[self._state]
+        self._state += ((guess, mask),)
+        if self._state in self._candidates:
+            return
+        if len(guess) != 1:
+            candidates = [candidate for candidate in candidates
+                          if candidate[0] != guess]
+        else:
+            index = letter_index(guess)
+            candidates = [candidate for candidate in candidates
+                          if candidate[1][index] == mask]
+        self._candidates[self._state] = candidates
+
+
+STRATEGIES = dict((strategy.name, strategy)
+                  for strategy in (FrequencyStrategy, CandidateStrategy))
+
+
+def run_batch(batch):
+    """Plays one batch of games in a worker process.
+    Args:
+        batch: (strategy name, word length, max_tries, games, seed)
+    Returns:
+        (strategy name, word length, max_tries, games, wins, Counter of wrong
+        guesses per game, Counter of guesses per won game, seconds taken)"""
+    name, length, max_tries, games, seed = batch
+    random.seed(seed)
+    strategy = STRATEGIES[name]()
+    words = words_of_length(length)
+    wins = 0
+    wrong = Counter()
+    guesses = Counter()
+    start = time.time()
+    for i in range(games):
+        won, wrong_guesses, total = hangman(
+                max_tries=max_tries,
+                word=random.choice(words)).simulate(strategy)
+        wrong[wrong_guesses] += 1
+        if won:
+            wins += 1
+            guesses[total] += 1
+    return (name, length, max_tries, games, wins, wrong, guesses,
+            time.time() - start)
+
+
+def simulate(strategies, lengths, max_tries, games, batch_size=1000,
+             processes=None, seed=0):
+    """Plays games for every combination of strategy, word length and
+    max_tries over a process pool. Returns ({(strategy, length, max_tries):
+    totals}, wall clock seconds)."""
+    batches = []
+    for name in strategies:
+        for length in lengths:
+            if not gamefunc.load_index().count(length):
+                raise ValueError('No words of length {}'.format(length))
+            for tries in max_tries:
+                for start in range(0, games, batch_size):
+                    batches.append((name, length, tries,
+                                    min(batch_size, games - start),
+                                    seed + len(batches)))
+    results = {}
+    pool = multiprocessing.Pool(processes)
+    began = time.time()
+    try:
+        for name, length, tries, played, wins, wrong, guesses, seconds in \
+                pool.imap_unordered(run_batch, batches):
+            totals = results.setdefault((name, length, tries), {
+                    'games': 0, 'wins': 0, 'wrong': Counter(),
+                    'guesses': Counter(), 'seconds': 0.0})
+            totals['games'] += played
+            totals['wins'] += wins
+            totals['wrong'].update(wrong)
+            totals['guesses'].update(guesses)
+            totals['seconds'] += seconds
+    finally:
+        pool.close()
+        pool.join()
+    return results, time.time() - began
+
+
+def report(results, elapsed):
+    total = sum(totals['games'] for totals in results.itervalues())
+    print '{} games in {:.1f}s, {:.0f} games/sec'.format(
+            total, elapsed, total / elapsed if elapsed else 0)
+    print '{:<12}{:>7}{:>6}{:>9}{:>9}{:>12}{:>12}  {}'.format(
+            'strategy', 'length', 'tries', 'win %', 'games/s', 'mean wrong',
+            'guesses/win', 'wrong guesses: games')
+    for (name, length, tries), totals in sorted(results.iteritems()):
+        games = totals['games']
+        wrong = totals['wrong']
+        guesses = totals['guesses']
+        print '{:<12}{:>7}{:>6}{:>9.1f}{:>9.0f}{:>12.2f}{:>12.2f}  {}'.format(
+                name, length, tries, 100.0 * totals['wins'] / games,
+                games / totals['seconds'] if totals['seconds'] else 0,
+                float(sum(n * count for n, count in wrong.iteritems())) / games,
+                float(sum(n * count for n, count in guesses.iteritems())) /
+                (totals['wins'] or 1),
+                ' '.join('{}:{}'.format(n, wrong[n]) for n in sorted(wrong)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--strategies', nargs='+', choices=sorted(STRATEGIES),
+                        default=sorted(STRATEGIES))
+    parser.add_argument('--lengths', nargs='+', type=int, default=[5])
+    parser.add_argument('--max-tries', nargs='+', type=int, default=[5])
+    parser.add_argument('--games', type=int, default=10000,
+                        help='games per strategy, length and max_tries')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--processes', type=int,
+                        help='worker processes, defaults to the CPU count')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    results, elapsed = simulate(args.strategies, args.lengths, args.max_tries,
+                                args.games, args.batch_size, args.processes,
+                                args.seed)
+    report(results, elapsed)
+
+
+if __name__ == '__main__':
+    main()
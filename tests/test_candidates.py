@@ -0,0 +1,59 @@
+"""Tests for candidates.py"""
+
+import random
+import unittest
+
+import candidates
+import gamefunc
+from gamestate import GameState
+
+
+def _states(games, seed=0):
+    """Yields (pattern, misses) of random games part way through"""
+    rng = random.Random(seed)
+    index = gamefunc.load_index()
+    for i in range(games):
+        state = GameState(index.random_word(rng.choice([3, 4, 5, 6, 8])))
+        for letter in rng.sample('abcdefghijklmnopqrstuvwxyz',
+                                 rng.randint(0, 8)):
+            state.guess(letter)
+        yield ''.join(state.masked()), ''.join(state.missed())
+
+
+class PythonHintTest(unittest.TestCase):
+
+    def test_no_words_fit(self):
+        self.assertEqual(candidates._hint_python('zzzzz', ''), (0, None, 0.0))
+
+    def test_one_word_left(self):
+        self.assertEqual(candidates._hint_python('he__o', ''), (1, None, 0.0))
+
+    def test_tie_goes_to_the_earlier_letter(self):
+        remaining, letter, entropy = candidates._hint_python('_hi_', 'efgoq')
+        self.assertEqual((remaining, letter), (6, 'p'))
+
+    def test_hint_ignores_missed_letters(self):
+        remaining, letter, entropy = candidates._hint_python('_____', 'e')
+        self.assertNotEqual(letter, 'e')
+        self.assertTrue(entropy > 0)
+
+
+class NumpyAgreementTest(unittest.TestCase):
+
+    def setUp(self):
+        if candidates._load_numpy() is None:
+            self.skipTest('NumPy is not installed')
+
+    def test_paths_agree(self):
+        states = [('zzzzz', ''), ('he__o', ''), ('_hi_', 'efgoq')]
+        states.extend(_states(200))
+        for pattern, misses in states:
+            numpy_hint = candidates._hint_numpy(pattern, misses)
+            python_hint = candidates._hint_python(pattern, misses)
+            self.assertEqual(numpy_hint[:2], python_hint[:2],
+                             (pattern, misses))
+            self.assertAlmostEqual(numpy_hint[2], python_hint[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
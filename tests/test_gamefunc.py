@@ -0,0 +1,68 @@
+"""Tests for the word index in gamefunc.py"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import gamefunc
+from gamefunc import StaleIndexError, WordFeatures, WordIndex
+
+WORDS = ['the', 'of', 'and', 'apple', 'house', 'zebra', 'to', 'cat']
+
+
+class WordIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.words = os.path.join(self.dir, 'dictionary.dat')
+        self.index = os.path.join(self.dir, 'dictionary.idx')
+        self._write_words(WORDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write_words(self, words):
+        with open(self.words, 'wb') as f:
+            f.write('\n'.join(words) + '\n')
+
+    def _build(self):
+        index = WordIndex.from_wordlist(self.words)
+        index.write(WordFeatures.from_wordlist(index, self.words), self.index)
+        return WordIndex.from_file(self.index)
+
+    def test_buckets(self):
+        index = WordIndex.from_wordlist(self.words)
+        self.assertEqual(index.count(5), 3)
+        self.assertEqual(index.count(4), 0)
+        self.assertEqual([index.word(3, i) for i in range(index.count(3))],
+                         ['the', 'and', 'cat'])
+        self.assertRaises(ValueError, index.random_word, 4)
+
+    def test_file_round_trip(self):
+        index = self._build()
+        index.verify(self.words)
+        self.assertEqual(index.bucket(5), 'applehousezebra')
+        self.assertEqual(index.count(2), 2)
+
+    def test_stale_after_words_added(self):
+        index = self._build()
+        self._write_words(WORDS + ['extra'])
+        self.assertRaises(StaleIndexError, index.verify, self.words)
+
+    def test_stale_after_reorder_of_same_size(self):
+        index = self._build()
+        self._write_words(list(reversed(WORDS)))
+        self.assertRaises(StaleIndexError, index.verify, self.words)
+
+    def test_unrecognised_format(self):
+        with open(self.index, 'wb') as f:
+            f.write('XXXX' + '\0' * 12)
+        self.assertRaises(StaleIndexError, WordIndex.from_file, self.index)
+
+    def test_shipped_index_matches_word_list(self):
+        WordIndex.from_file(gamefunc.INDEX_PATH).verify()
+
+
+if __name__ == '__main__':
+    unittest.main()
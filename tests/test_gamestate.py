@@ -0,0 +1,86 @@
+"""Tests for gamestate.py"""
+
+import unittest
+
+from gamestate import GameState, HIT, MISS, WIN
+
+
+class GuessTest(unittest.TestCase):
+
+    def test_hit_reveals_every_position_of_the_letter(self):
+        state = GameState('apple')
+        self.assertEqual(state.guess('p'), HIT)
+        self.assertEqual(state.masked(), ['_', 'p', 'p', '_', '_'])
+
+    def test_miss(self):
+        state = GameState('apple')
+        self.assertEqual(state.guess('z'), MISS)
+        self.assertEqual(state.masked(), ['_'] * 5)
+        self.assertEqual(state.missed(), ['z'])
+
+    def test_last_letter_wins(self):
+        state = GameState('abba')
+        self.assertEqual(state.guess('a'), HIT)
+        self.assertEqual(state.guess('b'), WIN)
+        self.assertTrue(state.won)
+
+    def test_whole_word(self):
+        state = GameState('apple')
+        self.assertEqual(state.guess('apples'), MISS)
+        self.assertEqual(state.guess('apple'), WIN)
+        self.assertEqual(state.masked(), list('apple'))
+
+    def test_moves_are_logged_in_order(self):
+        state = GameState('apple')
+        for guess in ('a', 'z', 'apply', 'p'):
+            state.guess(guess)
+        self.assertEqual(list(state.moves()), [('a', True), ('z', False),
+                                               ('apply', False), ('p', True)])
+
+
+class PackTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        state = GameState('apple')
+        for guess in ('p', 'z', 'q', 'apply', 'e'):
+            state.guess(guess)
+        unpacked = GameState.unpack('apple', state.pack())
+        self.assertEqual(unpacked.masked(), state.masked())
+        self.assertEqual(unpacked.missed(), ['q', 'z'])
+        self.assertEqual(list(unpacked.moves()), list(state.moves()))
+
+    def test_unknown_version(self):
+        packed = chr(99) + GameState('apple').pack()[1:]
+        self.assertRaises(ValueError, GameState.unpack, 'apple', packed)
+
+
+class FromPatternTest(unittest.TestCase):
+    """Games stored before the packed state, with current_guesses and a
+    move_history replayed through GameState.replay."""
+
+    def test_old_game_round_trip(self):
+        state = GameState.from_pattern('apple', ['a', '_', '_', '_', 'e'])
+        for guess, correct in (('a', True), ('z', False), ('e', True),
+                               ('q', False)):
+            state.replay(guess, correct)
+        unpacked = GameState.unpack('apple', state.pack())
+        self.assertEqual(unpacked.masked(), ['a', '_', '_', '_', 'e'])
+        self.assertEqual(unpacked.missed(), ['q', 'z'])
+        self.assertEqual(list(unpacked.moves()), [('a', True), ('z', False),
+                                                  ('e', True), ('q', False)])
+        # The migrated game carries on like any other.
+        self.assertEqual(unpacked.guess('p'), HIT)
+        self.assertEqual(unpacked.guess('l'), WIN)
+
+    def test_winner(self):
+        state = GameState.from_pattern('apple', ['winner'])
+        self.assertTrue(state.won)
+        self.assertEqual(state.missed(), [])
+
+    def test_skips_entries_that_are_not_one_letter(self):
+        state = GameState.from_pattern('apple', ['a', '', 'xx', '_', 'e'])
+        self.assertEqual(state.masked(), ['a', '_', '_', '_', 'e'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,123 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import threading
+import time
+from collections import OrderedDict
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-import endpoints
+
+from models import UserName
+import queries
+
+MEMCACHE_USER_KEY = 'USER_KEY:{}'
+USER_KEY_CACHE_SIZE = 2000
+USER_NAME_CACHE_SIZE = 5000
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SCHEDULED_CACHE_SIZE = 5000
+
+
+class LRUCache(object):
+    """A thread safe mapping that holds at most size entries, dropping the
+    least recently used entry when full."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# Task name -> the last time bucket this instance queued it for.
+_scheduled = LRUCache(SCHEDULED_CACHE_SIZE)
+
+# Per instance cache of user name -> User key, in front of memcache.
+_user_keys = LRUCache(USER_KEY_CACHE_SIZE)
+# Per instance cache of User key -> user name. User names never change.
+_user_names = LRUCache(USER_NAME_CACHE_SIZE)
+
+
+def _bad_request(message):
+    """Returns an endpoints.BadRequestException. endpoints is only imported
+    once a request is rejected, keeping it off the start up path of
+    instances that only run tasks."""
+    import endpoints
+    return endpoints.BadRequestException(message)
+
+
+def _user_key_cache_id(name):
+    return MEMCACHE_USER_KEY.format(name.encode('utf-8')
+                                    if isinstance(name, unicode) else name)
+
+
+def get_user_key(name):
+    """Returns the Key of the User with the given name, or None if there is no
+    such user. Lookups go through the instance cache, then memcache, then the
+    UserName index. Users created before the index are found by query and
+    added to it."""
+    return get_user_key_async(name).get_result()
+
+
+@ndb.tasklet
+def get_user_key_async(name):
+    """Tasklet version of get_user_key"""
+    if not name:
+        raise ndb.Return(None)
+    key = _user_keys.get(name)
+    if key:
+        raise ndb.Return(key)
+    context = ndb.get_context()
+    cache_id = _user_key_cache_id(name)
+    urlsafe = yield context.memcache_get(cache_id)
+    if urlsafe:
+        key = ndb.Key(urlsafe=urlsafe)
+    else:
+        index = yield UserName.get_by_id_async(name)
+        if index:
+            key = index.user
+        else:
+            key = yield queries.user_by_name(name).get_async(keys_only=True)
+            if not key:
+                raise ndb.Return(None)
+            yield UserName.get_or_insert_async(name, user=key)
+        yield context.memcache_set(cache_id, key.urlsafe())
+    _user_keys.set(name, key)
+    raise ndb.Return(key)
+
+
+def get_user(name):
+    """Returns the User with the given name, or None"""
+    key = get_user_key(name)
+    if key:
+        return key.get()
+    return None
+
+
+def forget_user_name(name):
+    """Drops any cached lookup of name, called when a user is created."""
+    _user_keys.delete(name)
+    memcache.delete(_user_key_cache_id(name))
+
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -17,19 +132,131 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception, e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
+    return get_multi_by_urlsafe([urlsafe], model)[0]
+
+
+def get_multi_by_urlsafe(urlsafes, model):
+    """Returns the ndb.Model entities that a list of urlsafe keys point to,
+        fetched with a single get_multi. Checks kinds in the same way as
+        get_by_urlsafe.
+    Args:
+        urlsafes: A list of urlsafe key strings
+        model: The expected entity kind
+    Returns:
+        A list of entities in the same order, with None where no entity
+        exists.
+    Raises:
+        ValueError:"""
+    return get_multi_by_urlsafe_async(urlsafes, model).get_result()
+
+
+@ndb.tasklet
+def get_multi_by_urlsafe_async(urlsafes, model):
+    """Tasklet version of get_multi_by_urlsafe"""
+    keys = []
+    for urlsafe in urlsafes:
+        try:
+            keys.append(ndb.Key(urlsafe=urlsafe))
+        except TypeError:
+            raise _bad_request('Invalid Key')
+        except Exception, e:
+            if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+                raise _bad_request('Invalid Key')
+            else:
+                raise
+
+    entities = yield ndb.get_multi_async(keys)
+    for entity in entities:
+        if entity and not isinstance(entity, model):
+            raise ValueError('Incorrect Kind')
+    raise ndb.Return(entities)
+
+
+def get_user_names(keys):
+    """Returns a dict of User key -> user name for the given keys. Names not
+    already cached on this instance are fetched with a single get_multi."""
+    return get_user_names_async(keys).get_result()
+
+
+@ndb.tasklet
+def get_user_names_async(keys):
+    """Tasklet version of get_user_names"""
+    names = {}
+    missing = []
+    for key in set(keys):
+        name = _user_names.get(key)
+        if name is None:
+            missing.append(key)
         else:
-            raise
-
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+            names[key] = name
+    if missing:
+        users = yield ndb.get_multi_async(missing)
+        for key, user in zip(missing, users):
+            if user:
+                names[key] = user.name
+                _user_names.set(key, user.name)
+    raise ndb.Return(names)
+
+
+def get_user_name(key):
+    """Returns the name of the User with the given key"""
+    return get_user_names([key]).get(key)
+
+
+def fetch_page(query, page_size=None, cursor=None, **options):
+    """Fetches one page of query results.
+    Args:
+        query: The ndb.Query to page through
+        page_size: Results per page, defaults to DEFAULT_PAGE_SIZE and is capped
+            at MAX_PAGE_SIZE
+        cursor: The urlsafe cursor returned with the previous page, if any
+        options: Extra query options, such as projection
+    Returns:
+        A tuple of the results and the urlsafe cursor of the next page, which
+        is None on the last page.
+    Raises:
+        BadRequestException: if page_size is negative or the cursor is
+            malformed"""
+    return fetch_page_async(query, page_size, cursor, **options).get_result()
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size=None, cursor=None, **options):
+    """Tasklet version of fetch_page"""
+    if page_size is not None and page_size < 0:
+        raise _bad_request('page_size must be positive')
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    start = None
+    if cursor:
+        try:
+            start = Cursor(urlsafe=cursor)
+        except Exception:
+            raise _bad_request('Invalid cursor')
+    results, next_cursor, more = yield query.fetch_page_async(
+            page_size, start_cursor=start, **options)
+    if more and next_cursor:
+        raise ndb.Return((results, next_cursor.urlsafe()))
+    raise ndb.Return((results, None))
+
+
+def schedule_debounced(url, name, interval, params=None):
+    """Queues a task to run at the end of the current interval, at most once
+    per interval across all instances. The task is named after the interval so
+    the task queue drops duplicates, and each instance remembers what it has
+    queued so repeats cost nothing. The task is added asynchronously and not
+    waited on, keeping it off the request's critical path.
+    Args:
+        url: The task handler
+        name: A task name prefix, unique to the task
+        interval: Seconds between runs
+        params: Optional dict of parameters passed to the task"""
+    now = time.time()
+    bucket = int(now) // interval
+    if _scheduled.get(name) == bucket:
+        return
+    _scheduled.set(name, bucket)
+    task = taskqueue.Task(url=url,
+                          name='{}-{}'.format(name, bucket),
+                          params=params,
+                          countdown=interval - now % interval)
+    taskqueue.Queue().add_async(task)